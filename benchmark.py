@@ -0,0 +1,269 @@
+'''
+
+    SwitchPick Benchmark
+        for SwitchPick for JUNOS
+
+Runs the switchpick.py workflows end to end against the JUNOS console emulator and
+reports the wall-clock time of each workflow, split into the phases it went through.
+Time spent outside any named phase (pasting configs, fixed sleeps) shows as "other".
+
+    python benchmark.py --rounds 3 --workflows prime,wipe --auto-update 0.4
+
+'''
+
+
+################################################################################
+#                                      Imports / Constants
+################################################################################
+
+import os, sys, time
+import tempfile, shutil
+import argparse
+
+import switchpick
+import emulator
+
+
+WORKFLOWS = ['prime', 'custom', 'wipe', 'wipe-loader', 'logs', 'logs-stream', 'reboot', 'power-off']
+
+#switchpick functions timed as phases, nested phases are charged to the innermost one
+PHASES = [
+    'checkActivity', 'goToLogin', 'goToState', 'login', 'cli', 'config', 'configSettled', 'goodCommit',
+    'upshift', 'downshift', 'loader', 'gatherProvisioningInfo', 'stageConfig',
+    ]
+
+
+
+################################################################################
+#                                      Phase Timing
+################################################################################
+
+class PhaseClock(object):
+    '''Charges wall-clock time to whichever phase is innermost at the moment'''
+    def __init__(self):
+        self.stack = ['other']
+        self.mark = time.time()
+        self.totals = {}
+
+    def charge(self):
+        now = time.time()
+        phase = self.stack[-1]
+        self.totals[phase] = self.totals.get(phase, 0.0) + (now - self.mark)
+        self.mark = now
+        return
+
+    def wrap(self, name, function):
+        def timed(*args, **kwargs):
+            self.charge()
+            self.stack.append(name)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.charge()
+                self.stack.pop()
+        return timed
+
+    def reset(self):
+        self.stack = ['other']
+        self.mark = time.time()
+        self.totals = {}
+        return
+
+
+def instrument(clock):
+    '''Swap the phase functions in switchpick for timed versions'''
+    for name in PHASES:
+        setattr(switchpick, name, clock.wrap(name, getattr(switchpick, name)))
+    return
+
+
+
+################################################################################
+#                                      Workflows
+################################################################################
+
+def customConfig(lines):
+    '''Write a set-format config of the given length to a temporary .txt file'''
+    handle, path = tempfile.mkstemp(suffix='.txt')
+    data = ['set system host-name bench-switch']
+    for index in range(lines - 1):
+        data.append('set interfaces ge-0/0/%d description "bench port %d"' % (index % 48, index))
+    os.write(handle, '\n'.join(data) + '\n')
+    os.close(handle)
+    return path
+
+
+def primeConfig(lines):
+    '''Write a stanza config of roughly the given length to a temporary .config file'''
+    handle, path = tempfile.mkstemp(suffix='.config')
+    data = ['system {', '    host-name bench-switch;', '    root-authentication {',
+        '        encrypted-password "$9$benchmark";', '    }', '}', 'interfaces {']
+    for index in range(max(1, (lines - 10) / 3)):
+        data += ['    ge-0/0/%d {' % index, '        description "bench port %d";' % index, '    }']
+    data += ['}']
+    os.write(handle, '\n'.join(data) + '\n')
+    os.close(handle)
+    return path
+
+
+def runWorkflow(name, switch, configs):
+    '''Run one workflow the way the menu would, minus the prompts'''
+    if name == 'prime':
+        return switchpick.applyConfig(configs['prime'])
+    elif name == 'custom':
+        return switchpick.applyConfig(configs['custom'])
+    elif name == 'wipe':
+        return switchpick.wipeSettings(False)
+    elif name == 'wipe-loader':
+        return switchpick.wipeSettings(True)
+    elif name == 'logs':
+        return switchpick.collectLogs()
+    elif name == 'logs-stream':
+        return switchpick.collectLogs(True)
+    elif name == 'reboot':
+        return switchpick.restartSwitch()
+    elif name == 'power-off':
+        return switchpick.haltSwitch()
+
+
+def benchmark(name, options, clock, configs, quiet, known=False):
+    '''Run a workflow against a fresh emulated switch, returns (seconds, phases, ok, switch)'''
+    #Loader wipes start from a powered-off switch, checkActivity() wakes it
+    switch = emulator.JunosConsole(state=('halted' if name == 'wipe-loader' else 'login'), **options)
+    path = switch.start()
+    current = switchpick.bindSession(switchpick.Session(switchpick.openSerialPort(path), path))
+    current.username, current.password = switch.username, switch.password
+    current.encryptedPassword = '$9$benchmark'
+    if known:   #As a menu session is after its first job on the switch
+        current.model, current.version = switch.model, '12.3R6'
+
+    stdout = sys.stdout
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+    clock.reset()
+    start = time.time()
+    try:
+        ok = runWorkflow(name, switch, configs) == True
+    except Exception as reason:
+        ok = False
+        stdout.write(name + ' failed: ' + str(reason) + '\n')
+    finally:
+        clock.charge()
+        sys.stdout = stdout
+    seconds = time.time() - start
+    if current.transcript is not None:
+        current.transcript.close()
+    current.console.close()
+    switch.stop()
+    return seconds, dict(clock.totals), ok, switch
+
+
+def report(results):
+    '''Print mean wall-clock per workflow and per phase'''
+    print('='*60)
+    print('Workflow        Runs  Failed   Mean(s)    Bytes in/out')
+    print('-'*60)
+    for name in WORKFLOWS:
+        runs = results.get(name)
+        if not runs:
+            continue
+        mean = sum([run[0] for run in runs]) / len(runs)
+        failed = len([run for run in runs if not run[2]])
+        bytesIn = sum([run[3].bytesIn for run in runs]) / len(runs)
+        bytesOut = sum([run[3].bytesOut for run in runs]) / len(runs)
+        print('%-15s %4d  %6d  %8.1f    %d/%d' % (name, len(runs), failed, mean, bytesIn, bytesOut))
+        phases = {}
+        for run in runs:
+            for phase in run[1]:
+                phases[phase] = phases.get(phase, 0.0) + run[1][phase] / len(runs)
+        for phase in sorted(phases, key=lambda phase: -phases[phase]):
+            if phases[phase] >= 0.05:
+                print('    %-26s %8.1f  %5.1f%%' % (phase, phases[phase], 100.0 * phases[phase] / mean))
+    print('='*60)
+    return
+
+
+
+################################################################################
+#                                      Function Calls
+################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark switchpick workflows against the JUNOS console emulator')
+    parser.add_argument('--workflows', default=','.join(WORKFLOWS), help='comma separated, from: ' + ', '.join(WORKFLOWS))
+    parser.add_argument('--rounds', type=int, default=1)
+    parser.add_argument('--config-lines', type=int, default=200, help='length of the generated configs')
+    parser.add_argument('--delay', type=float, default=0.05, help='emulated seconds before each prompt')
+    parser.add_argument('--commit-time', type=float, default=3.0)
+    parser.add_argument('--boot-time', type=float, default=20.0)
+    parser.add_argument('--loss', type=float, default=0.0, help='chance of losing any single byte')
+    parser.add_argument('--parse-delay', type=float, default=0.0, help='seconds the CLI spends on each loaded config line')
+    parser.add_argument('--rx-limit', type=int, default=0, help='bytes the switch buffers while busy, 0 for unlimited')
+    parser.add_argument('--auto-update', type=float, default=0.0, help='chance Auto-Update closes a config session')
+    parser.add_argument('--baud', type=int, default=9600, help='emulated line rate at 9600 baud console speed, scaled with faster speeds, 0 for unlimited')
+    parser.add_argument('--lease-time', type=float, default=0.0, help='seconds after a commit before the vlan gets a DHCP address')
+    parser.add_argument('--usb-disk', default='da1', help='disk name the USB drive attaches as')
+    parser.add_argument('--usb-delay', type=float, default=0.0, help='seconds after the start of a run before the USB drive goes in')
+    parser.add_argument('--disable-auto-update', action='store_true', help='remove Auto-Update with the factory-default commit')
+    parser.add_argument('--single-commit', action='store_true', help='commit the password with the loaded config')
+    parser.add_argument('--commit-check', action='store_true', help='run "commit check" before committing loaded configs')
+    parser.add_argument('--fast-path', default='skip', choices=['off', 'skip', 'delta'], help='repeat load handling')
+    parser.add_argument('--fast-transfer', action='store_true', help='paste configs at ' + str(switchpick.FAST_BAUDRATE) + ' baud')
+    parser.add_argument('--transfer', default='paste', choices=['paste', 'upload'], help='how configs reach the switch')
+    parser.add_argument('--known-model', action='store_true', help='runs start knowing the switch model, so timing profiles apply')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--verbose', action='store_true', help='show switchpick output')
+    parser.add_argument('--keep-timing', action='store_true', help="keep switchpick's own span log, metrics file and transcripts")
+    arguments = parser.parse_args()
+
+    options = {
+        'delay': arguments.delay, 'commitTime': arguments.commit_time, 'bootTime': arguments.boot_time,
+        'loss': arguments.loss, 'autoUpdate': arguments.auto_update, 'baud': arguments.baud,
+        'parseDelay': arguments.parse_delay, 'rxLimit': arguments.rx_limit,
+        'leaseTime': arguments.lease_time, 'usbDisk': arguments.usb_disk, 'usbDelay': arguments.usb_delay,
+        'seed': arguments.seed,
+        }
+    workflows = [name.strip() for name in arguments.workflows.split(',') if name.strip()]
+    for name in workflows:
+        if name not in WORKFLOWS:
+            parser.error('unknown workflow: ' + name)
+
+    switchpick.DISABLE_AUTO_UPDATE = arguments.disable_auto_update
+    switchpick.SINGLE_COMMIT = arguments.single_commit
+    switchpick.COMMIT_CHECK = arguments.commit_check
+    switchpick.FAST_PATH = arguments.fast_path
+    switchpick.FAST_TRANSFER = arguments.fast_transfer
+    switchpick.CONFIG_TRANSFER = arguments.transfer
+    #Keep benchmark deployments out of the real provisioning log
+    switchpick.PROVISIONING_DB = os.path.join(tempfile.mkdtemp(), 'deployments.db')
+    switchpick.TIMING_LOG = os.path.join(os.path.dirname(switchpick.PROVISIONING_DB), 'timing.jsonl')
+    switchpick.TIMING_METRICS = os.path.join(os.path.dirname(switchpick.PROVISIONING_DB), 'switchpick.prom')
+    switchpick.TRANSCRIPTS = os.path.join(os.path.dirname(switchpick.PROVISIONING_DB), 'transcripts')
+    switchpick.LOG_DIRECTORY = os.path.join(os.path.dirname(switchpick.PROVISIONING_DB), 'logs')
+    #The shipped prime.config is a stub, both loads use generated configs of a set length
+    configs = {'prime': primeConfig(arguments.config_lines), 'custom': customConfig(arguments.config_lines)}
+    clock = PhaseClock()
+    instrument(clock)
+
+    results = {}
+    try:
+        for round in range(arguments.rounds):
+            for name in workflows:
+                print('Round %d: %s...' % (round + 1, name))
+                results.setdefault(name, []).append(benchmark(name, options, clock, configs, not arguments.verbose,
+                    arguments.known_model))
+    except KeyboardInterrupt:
+        print('Interrupted - partial results:')
+    finally:
+        for path in configs.values():
+            os.remove(path)
+        if arguments.keep_timing:
+            print('Phase spans: ' + switchpick.TIMING_LOG + '\nMetrics: ' + switchpick.TIMING_METRICS +
+                '\nTranscripts: ' + switchpick.TRANSCRIPTS)
+        else:
+            shutil.rmtree(os.path.dirname(switchpick.PROVISIONING_DB))
+    report(results)
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1148 @@
+'''
+
+    JUNOS Console Emulator
+        for SwitchPick for JUNOS
+
+A pseudo-terminal that behaves like the serial console of a Juniper EX switch, so the
+switchpick.py workflows can be tested and timed without a switch on the bench.
+Models the login, shell, operational, configuration, commit, loader and reboot states,
+with adjustable delays, byte loss and the Auto-Update session drops seen on real units.
+
+    python emulator.py --delay 0.1 --auto-update 0.4
+    python switchpick.py --port /dev/pts/N
+
+'''
+
+
+################################################################################
+#                                      Imports / Constants
+################################################################################
+
+import os, sys, time
+import pty, tty, termios, fcntl
+import select, threading, errno
+import random, fnmatch, heapq
+import hashlib, base64
+import gzip, io, shlex
+import argparse
+
+
+FACTORY_DEFAULT = [
+    'set system syslog user * any emergency',
+    'set system commit factory-settings',
+    'set chassis auto-image-upgrade',
+    'set interfaces vlan unit 0 family inet dhcp',
+    'set protocols lldp interface all',
+    'set ethernet-switching-options storm-control interface all',
+    ]
+
+SHELL_PROMPT = 'root@:RE:0% '
+OPERATIONAL_PROMPT = '\r\n{master:0}\r\n%s> '
+CONFIG_PROMPT = '\r\n{master:0}[edit]\r\n%s# '
+LOADER_PROMPT = 'loader> '
+
+#(fraction of boot time, console text) - the milestones a real EX prints on the way up
+BOOT_MESSAGES = [
+    (0.00, 'U-Boot 1.1.6 (Built by builder on 2014-03-13 - 06:28:33)\r\n\r\n'
+           'FreeBSD/MIPS U-Boot bootstrap loader, Revision 2.4\r\n'),
+    (0.05, 'Hit [Enter] to boot immediately, or space bar for command prompt.\r\n'
+           'Booting [/kernel] in 1 second...\r\n'),
+    (0.15, 'Kernel entry at 0x800000e0 ...\r\n'
+           'Copyright (c) 1996-2014, Juniper Networks, Inc.\r\n'
+           'JUNOS 12.3R6.6 #0: 2014-03-13 07:29:04 UTC\r\n'),
+    (0.40, 'Mounting JUNOS packages:\r\n'
+           'Checking integrity of BSD labels:\r\n'),
+    (0.60, 'Starting management process (mgd)\r\n'
+           'mgd: commit complete\r\n'),
+    (0.85, 'Local package initialization:.\r\n'
+           'Interfaces up: ge-0/0/0 ge-0/0/1 ge-0/0/2 ge-0/0/3 me0 vlan\r\n'
+           'Starting cron.\r\n'),
+    ]
+COUNTDOWN = 1.5     #Seconds the loader countdown accepts a space bar
+
+SHUTDOWN_MESSAGE = ('Shutdown NOW!\r\n\r\n'
+    '*** FINAL System shutdown message from root@ ***\r\n'
+    'System going down IMMEDIATELY\r\n\r\n')
+SYNC_MESSAGE = ('Waiting (max 60 seconds) for system process `vnlru_mem\' to stop...done\r\n'
+    'syncing disks... All buffers synced.\r\n')
+
+
+
+################################################################################
+#                                      Console Emulator
+################################################################################
+
+class JunosConsole(object):
+    '''
+    One emulated switch on one pseudo-terminal. Point switchpick at .path.
+    Timing is in seconds, loss is the chance of any single byte going missing
+    and autoUpdate the chance that a "configure" session is closed by Auto-Update.
+    '''
+    def __init__(self, model='EX2200-24T-4G', serialNumber='CW0211270001', mac='00:1f:12:34:56:01',
+            address='10.0.0.21', subnet='10.0.0/24', username='root', password='root',
+            delay=0.05, commitTime=3.0, rsiTime=8.0, archiveTime=2.0, bootTime=20.0,
+            haltTime=6.0, recoveryTime=8.0, loss=0.0, autoUpdate=0.0, baud=9600,
+            parseDelay=0.0, rxLimit=0, usb=True, usbDisk='da1', usbDelay=0.0, leaseTime=0.0, state='login', seed=None):
+        self.model, self.serialNumber, self.mac = model, serialNumber, mac
+        self.address, self.subnet = address, subnet
+        self.username, self.password = username, password
+        self.delay, self.commitTime, self.rsiTime = delay, commitTime, rsiTime
+        self.archiveTime, self.bootTime, self.haltTime = archiveTime, bootTime, haltTime
+        self.recoveryTime, self.loss, self.autoUpdate = recoveryTime, loss, autoUpdate
+        self.baud, self.parseDelay, self.rxLimit, self.usb = baud, parseDelay, rxLimit, usb
+        self.usbDisk, self.usbDelay = usbDisk, usbDelay
+        self.leaseTime = leaseTime
+        self.leaseAt = time.time() + leaseTime    #The vlan has no DHCP address until then
+        self.random = random.Random(seed)
+
+        self.active = list(FACTORY_DEFAULT)
+        self.candidate = list(FACTORY_DEFAULT)
+        self.history = []
+        self.speed = 9600           #Console speed the switch is using
+        self.state = state
+        self.user = username
+        self.parents = []           #Where "exit" goes, shells and CLIs nest like real processes
+        self.cwd = '/'
+        self.files = {
+            '/config': set(['juniper.conf.gz', 'juniper.conf.1.gz', 'juniper.conf.2.gz', 'rescue.conf.gz']),
+            '/var/run/db': set(['juniper.db', 'juniper.data', 'juniper.save']),
+            '/var/tmp': set(),
+            '/dev': set(['da0', 'da0s1', 'da0s1a', 'da0s2', 'da0s2a', 'da0s3', 'da0s3d', 'da0s3e']),
+            }
+        if usb and not usbDelay:    #Otherwise the drive goes in usbDelay seconds after start()
+            self.files['/dev'].update([usbDisk, usbDisk + 's1'])
+        self.mounts = [('/dev/da0s1a', '/', 'ufs'), ('/dev/da0s3e', '/var', 'ufs')]
+        self.contents = {}          #Text of files written with "| save"
+        self.status = 0             #Exit code of the last shell command
+
+        self.line = ''
+        self.lastKey = ''
+        self.loadMode = ''
+        self.loadLines = []
+        self.catPath = ''
+        self.catLines = []
+        self.confirmAction = None
+        self.busy = False
+        self.typeahead = ''
+        self.generation = 0         #Bumped to cancel pending boot/drop events
+        self.rollbackTimer = 0
+
+        self.events = []
+        self.sequence = 0
+        self.tx = []
+        self.txCredit = 0.0
+        self.rxCredit = 0.0
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.running = False
+        self.master = self.slave = None
+        self.path = ''
+
+    ############################################################################
+    #   Pseudo-terminal plumbing
+    ############################################################################
+
+    def start(self):
+        '''Open the pseudo-terminal and serve it from a background thread'''
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        flags = fcntl.fcntl(self.master, fcntl.F_GETFL)
+        fcntl.fcntl(self.master, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.path = os.ttyname(self.slave)
+        self.running = True
+        if self.usb and self.usbDelay:
+            self.later(self.usbDelay, self.attachUsb)
+        self.thread = threading.Thread(target=self.run, name='emulator ' + self.path)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.path
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+        return
+
+    def run(self):
+        last = time.time()
+        while self.running:
+            now = time.time()
+            rate = self.rate()
+            burst = max(16.0, rate / 10.0 * 0.05)
+            if self.baud:
+                self.txCredit = min(self.txCredit + (now - last) * rate / 10.0, burst)
+                self.rxCredit = min(self.rxCredit + (now - last) * rate / 10.0, burst)
+            last = now
+            self.fire(now)
+            self.transmit()
+
+            throttled = self.baud and (self.rxCredit < 1)
+            wait = 0.2
+            if self.events:
+                wait = min(wait, max(0, self.events[0][0] - now))
+            if self.tx or throttled:
+                wait = min(wait, 0.005)
+            watch = [] if throttled else [self.master]
+            readable = select.select(watch, [], [], wait)[0]
+            if readable:
+                size = int(self.rxCredit) if self.baud else 4096
+                try:
+                    data = os.read(self.master, max(1, min(size, 4096)))
+                except OSError:
+                    continue    #Host side closed, keep serving for the next open
+                self.rxCredit -= len(data)
+                self.bytesIn += len(data)
+                self.receive(data)
+        return
+
+    def linked(self):
+        '''True when the host port runs at the switch's console speed'''
+        speed = getattr(termios, 'B' + str(self.speed), None)
+        try:
+            return termios.tcgetattr(self.slave)[5] == speed
+        except termios.error:
+            return True
+
+    def rate(self):
+        '''Line rate to pace at, baud scaled up to the console speed the switch negotiated'''
+        if self.baud and self.linked():
+            return self.baud * self.speed / 9600.0
+        return self.baud
+
+    def lose(self, data):
+        if self.loss:
+            data = ''.join([c for c in data if self.random.random() >= self.loss])
+        return data
+
+    def transmit(self):
+        while self.tx:
+            item = self.tx[0]
+            if callable(item):
+                self.tx.pop(0)
+                item()
+                continue
+            size = int(self.txCredit) if self.baud else len(item)
+            if size < 1:
+                return
+            chunk = item[:size]
+            kept = self.lose(chunk)
+            data = kept
+            if not self.linked():   #Wrong speed, the host only sees framing garbage
+                data = ''.join([chr(self.random.randint(0x80, 0xff)) for c in data])
+            try:
+                written = os.write(self.master, data) if data else 0
+            except OSError as error:
+                if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return      #Host isn't reading, try again later
+                written = len(data)
+            if written < len(data):     #PTY buffer full, the rest of the chunk goes out later
+                sent = 0
+                for c in kept[:written]:
+                    sent = chunk.index(c, sent) + 1
+                chunk = chunk[:sent]
+            self.txCredit -= len(chunk)
+            self.bytesOut += len(chunk)
+            if len(chunk) == len(item):
+                self.tx.pop(0)
+            else:
+                self.tx[0] = item[len(chunk):]
+            if written < len(data):
+                return
+        return
+
+    def out(self, item):
+        '''Queue console text (or a callable that runs when the text before it is sent)'''
+        if item != '':  #Unpaced lines would stall on an empty string
+            self.tx.append(item)
+        return
+
+    def later(self, delay, action):
+        self.sequence += 1
+        heapq.heappush(self.events, (time.time() + delay, self.sequence, action))
+        return
+
+    def fire(self, now):
+        while self.events and (self.events[0][0] <= now):
+            heapq.heappop(self.events)[2]()
+        return
+
+    ############################################################################
+    #   Keyboard handling
+    ############################################################################
+
+    def receive(self, data):
+        if not self.linked():
+            return      #Garbage at the wrong speed, the switch ignores it
+        for key in self.lose(data):
+            if self.busy:
+                if self.rxLimit and (len(self.typeahead) >= self.rxLimit):
+                    continue    #Switch side input buffer overrun
+                self.typeahead += key
+            else:
+                self.key(key)
+        return
+
+    def key(self, key):
+        state = self.state
+        if state in ('booting', 'shutdown', 'unplugged'):
+            return
+        elif state == 'countdown':
+            if key == ' ':
+                self.generation += 1    #Cancel the rest of the boot
+                self.state = 'loader'
+                self.out('\r\nType \'?\' for a list of commands, \'help\' for more detailed help.\r\n' + LOADER_PROMPT)
+            return
+        elif state == 'halted':
+            self.boot()
+            return
+
+        if (key == '\n') and (self.lastKey == '\r'):
+            self.lastKey = key
+            return
+        self.lastKey = key
+        if (key == '\x04') and (state == 'terminal') and (self.line == ''):
+            self.finishLoad()
+        elif (key == '\x04') and (state == 'cat') and (self.line == ''):
+            self.finishCat()
+        elif key in ('\r', '\n'):
+            line, self.line = self.line, ''
+            self.out('\r\n')
+            self.enter(line)
+        elif key == '\x15':     #Ctrl-U erases the line
+            self.line = ''
+            self.out('\r\n')
+        elif key == '\x03':     #Ctrl-C
+            self.line = ''
+            self.interrupt()
+        elif key in ('\x08', '\x7f'):
+            self.line = self.line[:-1]
+        else:
+            self.line += key
+            if state != 'password':
+                self.out(key)
+        return
+
+    def respond(self, text, after=None, then=None):
+        '''Answer a command after a delay, input typed meanwhile waits its turn'''
+        self.busy = True
+        def done():
+            if then is not None:
+                then()
+            self.out(text + self.prompt())
+            self.out(self.ready)
+        self.later(self.delay if after is None else after, done)
+        return
+
+    def ready(self):
+        '''Runs once a response is on the wire, replays type-ahead'''
+        self.busy = False
+        typeahead, self.typeahead = self.typeahead, ''
+        for index in range(len(typeahead)):
+            if self.busy:
+                self.typeahead = typeahead[index:] + self.typeahead
+                break
+            self.key(typeahead[index])
+        return
+
+    def prompt(self):
+        return {
+            'login': 'login: ',
+            'password': 'Password:',
+            'shell': SHELL_PROMPT,
+            'operational': OPERATIONAL_PROMPT % self.user,
+            'configuration': CONFIG_PROMPT % self.user,
+            'loader': LOADER_PROMPT,
+            }.get(self.state, '')
+
+    def enter(self, line):
+        handler = {
+            'login': self.loginLine,
+            'password': self.passwordLine,
+            'shell': self.shellLine,
+            'operational': self.cliLine,
+            'configuration': self.configLine,
+            'terminal': self.terminalLine,
+            'cat': self.catLine,
+            'confirm': self.confirmLine,
+            'loader': self.loaderLine,
+            'single': self.singleLine,
+            }.get(self.state)
+        if handler is not None:
+            handler(line.strip('\r'))
+        return
+
+    def interrupt(self):
+        if self.state == 'terminal':
+            self.loadLines = []
+            self.state = 'configuration'
+            self.respond('load cancelled\r\n')
+        elif self.state == 'cat':
+            self.catLines = []
+            self.state = 'shell'
+            self.respond('')
+        elif self.state in ('shell', 'operational', 'configuration'):
+            self.respond('')
+        return
+
+    ############################################################################
+    #   Login
+    ############################################################################
+
+    def loginLine(self, line):
+        if line.strip() == '':
+            self.respond('')
+            return
+        self.user = line.strip()
+        self.state = 'password'
+        self.respond('')
+        return
+
+    def passwordLine(self, line):
+        if (self.user in (self.username, 'root')) and (line == self.password):
+            banner = '\r\n--- JUNOS 12.3R6.6 built 2014-03-13 06:56:10 UTC\r\n'
+            if self.user == 'root':
+                self.state, self.parents = 'shell', ['login']
+            else:
+                self.state, self.parents = 'operational', ['login']
+            self.respond(banner)
+        else:
+            self.state = 'login'
+            self.respond('\r\nLogin incorrect\r\n', after=max(self.delay, 1.0))
+        return
+
+    ############################################################################
+    #   Shell (%)
+    ############################################################################
+
+    def shellLine(self, line):
+        output = []
+        elapsed = background = 0.0  #When the foreground and the background jobs finish
+        for statement, detached in self.statements(line):
+            try:
+                words = shlex.split(statement)
+            except ValueError:
+                words = statement.split()
+            if words == []:
+                continue
+            elif words == ['wait']:
+                elapsed = max(elapsed, background)
+                continue
+            self.duration = 0.0
+            result = self.shellCommand(words)
+            if result is None:
+                return      #The command changed state and answered on its own
+            if detached:
+                background = max(background, elapsed + self.duration)
+            else:
+                elapsed += self.duration
+            output.append(result)
+        self.respond(''.join(output), after=(self.delay + elapsed))
+        return
+
+    def statements(self, line):
+        '''Split a shell line at ; and &, outside quotes, as (statement, backgrounded) pairs'''
+        statements, current, quote = [], '', None
+        for character in line:
+            if quote:
+                quote = None if character == quote else quote
+            elif character in '"\'':
+                quote = character
+            elif character in ';&':
+                statements.append((current, character == '&'))
+                current = ''
+                continue
+            current += character
+        statements.append((current, False))
+        return statements
+
+    def shellCommand(self, words):
+        name, arguments = words[0], words[1:]
+        previous, self.status = self.status, 0
+        if (name == 'cli') and (arguments[:1] == ['-c']):
+            return self.cliCommand(' '.join(arguments[1:]))
+        elif name == 'cli':
+            self.state = 'operational'
+            self.parents.append('shell')
+            self.respond('')
+            return None
+        elif name in ('exit', 'logout'):
+            self.state = self.parents.pop() if self.parents else 'login'
+            self.respond('')
+            return None
+        elif name == 'cd':
+            directory = self.resolve(arguments[0] if arguments else '/')
+            if directory in self.files or directory == '/':
+                self.cwd = directory
+                return ''
+            self.status = 1
+            return directory + ': No such file or directory.\r\n'
+        elif name == 'rm':
+            output = ''
+            for pattern in [argument for argument in arguments if not argument.startswith('-')]:
+                if not self.remove(self.resolve(pattern)) and ('-f' not in arguments):
+                    self.status = 1
+                    output += 'rm: ' + pattern + ': No such file or directory\r\n'
+            return output
+        elif (name == 'ls') and [argument for argument in arguments if '*' in argument]:
+            paths = []
+            for pattern in [self.resolve(argument) for argument in arguments if not argument.startswith('-')]:
+                directory, names = pattern.rsplit('/', 1)
+                paths += [directory + '/' + name for name in sorted(fnmatch.filter(self.files.get(directory or '/', []), names))]
+            if paths == []:
+                self.status = 1
+                return 'ls: No match.\r\n'
+            return self.columns(paths, '-1' in arguments)
+        elif name == 'ls':
+            output = ''
+            for directory in [self.resolve(argument) for argument in arguments if not argument.startswith('-')] or [self.cwd]:
+                parent, base = directory.rsplit('/', 1)
+                if (directory not in self.files) and (directory != '/'):
+                    if base in self.files.get(parent or '/', ()):
+                        output += directory + '\r\n'
+                    else:
+                        self.status = 1
+                        output += 'ls: ' + directory + ': No such file or directory\r\n'
+                    continue
+                if len([argument for argument in arguments if not argument.startswith('-')]) > 1:
+                    output += directory + ':\r\n'
+                output += self.columns(sorted(self.files.get(directory, [])), '-1' in arguments)
+            return output
+        elif name == 'echo':
+            return ' '.join(arguments).replace('$status', str(previous)).replace('$?', str(previous)) + '\r\n'
+        elif (name == 'mount_msdosfs') and (len(arguments) >= 2):
+            if (self.user != 'root'):
+                self.status = 1
+                return 'mount_msdosfs: ' + arguments[-2] + ': Operation not permitted\r\n'
+            device = self.resolve(arguments[-2])
+            if (device.rsplit('/', 1)[-1] in self.files['/dev']) and not [mount for mount in self.mounts if mount[0].startswith(device)]:
+                self.mounts.append((arguments[-2], self.resolve(arguments[-1]), 'msdosfs'))
+                return ''
+            self.status = 1
+            return 'mount_msdosfs: ' + arguments[-2] + ': No such file or directory\r\n'
+        elif (name == 'mount') and (arguments == []):
+            return ''.join(['%s on %s (%s, local)\r\n' % mount for mount in self.mounts])
+        elif (name == 'umount') and arguments:
+            mounted = [mount for mount in self.mounts if self.resolve(arguments[-1]) in mount[:2]]
+            if mounted == []:
+                self.status = 1
+                return 'umount: ' + arguments[-1] + ': not a file system root directory\r\n'
+            self.mounts.remove(mounted[0])
+            return ''
+        elif (name == 'md5') and arguments:
+            path = self.resolve(arguments[-1])
+            if path in self.contents:
+                return hashlib.md5(self.contents[path]).hexdigest() + '\r\n'
+            self.status = 1
+            return 'md5: ' + arguments[-1] + ': No such file or directory\r\n'
+        elif (name == 'wc') and arguments:
+            path = self.resolve(arguments[-1])
+            if path in self.contents:
+                return '%8d %s\r\n' % (len(self.contents[path]), arguments[-1])
+            self.status = 1
+            return 'wc: ' + arguments[-1] + ': No such file or directory\r\n'
+        elif (name == 'gzip') and arguments:
+            path = self.resolve(arguments[-1])
+            if path not in self.contents:
+                self.status = 1
+                return 'gzip: ' + arguments[-1] + ': No such file or directory\r\n'
+            self.store(path + '.gz', self.compress(self.contents.pop(path)))
+            self.remove(path)
+            return ''
+        elif (name == 'uuencode') and ('-m' in arguments):
+            path = self.resolve([argument for argument in arguments if argument != '-m'][0])
+            if path not in self.contents:
+                self.status = 1
+                return 'uuencode: ' + path + ': No such file or directory\r\n'
+            encoded = base64.b64encode(self.contents[path])
+            lines = [encoded[index:index + 76] for index in range(0, len(encoded), 76)]
+            self.duration = len(encoded) / 200000.0     #The encoding itself is quick, the line is not
+            return 'begin-base64 644 ' + arguments[-1] + '\r\n' + ''.join([line + '\r\n' for line in lines]) + '====\r\n'
+        elif (name == 'cat') and (arguments[:1] == ['>']) and (len(arguments) == 2):
+            self.state, self.catPath, self.catLines = 'cat', self.resolve(arguments[1]), []
+            return None     #Reads the terminal until ^D
+        elif (name == 'uudecode') and ('-o' in arguments):
+            output = self.resolve(arguments[arguments.index('-o') + 1])
+            source = self.resolve(arguments[-1])
+            lines = self.contents.get(source, '').split('\n')
+            starts = [index for index in range(len(lines)) if lines[index].startswith('begin-base64')]
+            if (starts == []) or ('====' not in lines):
+                self.status = 1
+                return 'uudecode: ' + arguments[-1] + ': no "begin" line\r\n'
+            try:
+                self.store(output, base64.b64decode(''.join(lines[starts[0] + 1:lines.index('====')])))
+            except (TypeError, ValueError):
+                self.status = 1
+                return 'uudecode: ' + arguments[-1] + ': illegal character\r\n'
+            return ''
+        elif (name == 'gunzip') and arguments:
+            path = self.resolve(arguments[-1])
+            try:
+                data = gzip.GzipFile(fileobj=io.BytesIO(self.contents[path])).read()
+            except (KeyError, IOError):
+                self.status = 1
+                return 'gunzip: ' + arguments[-1] + ': not in gzip format\r\n'
+            self.remove(path)
+            self.store(path[:-3] if path.endswith('.gz') else path + '.out', data)
+            return ''
+        elif name in ('cp', 'sync', 'cat', 'tar'):
+            return ''
+        self.status = 1
+        return name + ': Command not found.\r\n'
+
+    def cliCommand(self, line):
+        '''Run a CLI command for "cli -c", the output comes back after self.duration'''
+        parts = [part.strip() for part in line.split('|')]
+        command = ' '.join(parts[0].split())
+        if command.startswith('request support information'):
+            self.duration = self.rsiTime
+            return self.pipe(self.supportInformation(), parts[1:])
+        elif command.startswith('file archive'):
+            self.duration = self.archiveTime
+            self.archive(command)
+            return ''
+        self.status = 1
+        return 'error: syntax error: ' + command.split()[0] + '\r\n'
+
+    def supportInformation(self):
+        '''Text for "request support information", long and about as repetitive as the real one'''
+        lines = ['Hostname: ' + (self.hostname() or 'Amnesiac'), 'Model: ' + self.model.lower(), 'JUNOS Base OS boot [12.3R6.6]']
+        for index in range(400):
+            lines.append('ge-0/0/%d  up  up  input packets: %d  output packets: %d  errors: %d' % (index % 48,
+                self.random.randint(0, 10**9), self.random.randint(0, 10**9), self.random.randint(0, 3)))
+        return '\r\n'.join(lines) + '\r\n'
+
+    def archive(self, command):
+        '''Write the /var/log archive for "file archive [compress] source ... destination ..."'''
+        words = command.split()
+        destination = words[words.index('destination') + 1] if 'destination' in words else '/var/tmp/archive'
+        logs = self.supportInformation().replace('\r\n', '\n') * 3
+        if 'compress' in words:
+            self.store(self.resolve(destination + '.tgz'), self.compress(logs))
+        else:
+            self.store(self.resolve(destination + '.tar'), logs)
+        return
+
+    def compress(self, data):
+        buffer = io.BytesIO()
+        archive = gzip.GzipFile(fileobj=buffer, mode='wb')
+        archive.write(data)
+        archive.close()
+        return buffer.getvalue()
+
+    def store(self, path, data):
+        directory, name = path.rsplit('/', 1)
+        self.files.setdefault(directory or '/', set()).add(name)
+        self.contents[path] = data
+        return
+
+    def catLine(self, line):
+        self.catLines.append(line)
+        return
+
+    def finishCat(self):
+        self.store(self.catPath, ''.join([line + '\n' for line in self.catLines]))
+        self.catLines = []
+        self.state = 'shell'
+        self.respond('')
+        return
+
+    def resolve(self, path):
+        if not path.startswith('/'):
+            path = self.cwd.rstrip('/') + '/' + path
+        return path.rstrip('/') or '/'
+
+    def deleteFile(self, path):
+        '''"file delete" from the CLI, returns its output'''
+        path = self.resolve(path)
+        return '' if self.remove(path) else 'error: could not delete ' + path + '\r\n'
+
+    def columns(self, names, single=False):
+        '''ls output, down then across an 80 column tty like FreeBSD ls, or one per line with -1'''
+        if single or not names:
+            return ''.join([name + '\r\n' for name in names])
+        width = max([len(name) for name in names]) + 2
+        rows = -(-len(names) // max(1, 80 // width))
+        return ''.join([''.join([name.ljust(width) for name in names[row::rows]]).rstrip() + '\r\n'
+            for row in range(rows)])
+
+    def remove(self, path):
+        directory, pattern = path.rsplit('/', 1)
+        names = self.files.get(directory or '/', set())
+        matched = fnmatch.filter(names, pattern)
+        names.difference_update(matched)
+        for name in matched:
+            self.contents.pop((directory or '') + '/' + name, None)
+        return matched != []
+
+    ############################################################################
+    #   Operational mode (>)
+    ############################################################################
+
+    def cliLine(self, line):
+        parts = [part.strip() for part in line.split('|')]
+        command = ' '.join(parts[0].split())
+        pipes = parts[1:]
+
+        if command == '':
+            self.respond('')
+        elif command in ('exit', 'quit'):
+            self.state = self.parents.pop() if self.parents else 'login'
+            self.respond('')
+        elif command in ('configure', 'edit', 'configure private', 'configure exclusive'):
+            self.enterConfiguration()
+        elif command == 'start shell':
+            self.state = 'shell'
+            self.parents.append('operational')
+            self.respond('')
+        elif command.startswith('show') and ('display xml' in pipes):
+            self.respond(self.showXml(command))
+        elif command.startswith('show'):
+            self.respond(self.pipe(self.show(command), pipes))
+        elif command.startswith('request support information'):
+            self.respond(self.pipe(self.supportInformation(), pipes), after=self.rsiTime)
+        elif command.startswith('file archive'):
+            self.archive(command)
+            self.respond('', after=self.archiveTime)
+        elif command.startswith('file checksum md5 '):
+            path = self.resolve(command.split()[-1])
+            if path in self.contents:
+                self.respond('MD5 (' + path + ') = ' + hashlib.md5(self.contents[path]).hexdigest() + '\r\n')
+            else:
+                self.respond('error: could not resolve file: ' + path + '\r\n')
+        elif command.startswith('file delete '):
+            self.respond(self.deleteFile(command.split()[-1]))
+        elif command.startswith('request system configuration rescue save'):
+            self.respond('')
+        elif command.startswith('request system reboot'):
+            self.confirm('Reboot the system ? [yes,no] (no) ', self.reboot)
+        elif command.startswith('request system power-off') or command.startswith('request system halt'):
+            self.confirm('Power Off the system ? [yes,no] (no) ', self.halt)
+        else:
+            self.respond('                    ^\r\nunknown command.\r\n')
+        return
+
+    def show(self, command):
+        if command.startswith('show chassis hardware'):
+            return ('Hardware inventory:\r\n'
+                'Item             Version  Part number  Serial number     Description\r\n'
+                'Chassis                                ' + self.serialNumber + '      ' + self.model + '\r\n'
+                'Routing Engine 0 REV 10   750-026468   ' + self.serialNumber + '      ' + self.model + '\r\n'
+                'FPC 0            REV 10   750-026468   ' + self.serialNumber + '      ' + self.model + '\r\n')
+        elif command.startswith('show interfaces vlan'):
+            return ('Physical interface: vlan, Enabled, Physical link is Up\r\n'
+                '  Interface index: 128, SNMP ifIndex: 26\r\n'
+                '  Type: VLAN, Link-level type: VLAN, MTU: 1518, Speed: 1000mbps\r\n'
+                '  Current address: ' + self.mac + ', Hardware address: ' + self.mac + '\r\n'
+                '  Logical interface vlan.0 (Index 68) (SNMP ifIndex 27)\r\n'
+                '    Protocol inet, MTU: 1500\r\n'
+                '      Flags: Sendbcast-pkt-to-re, Is-Primary\r\n'
+                + ('      Addresses, Flags: Dest-route-down Is-Default Is-Preferred Is-Primary\r\n'
+                '        Destination: ' + self.subnet + ', Local: ' + self.address + ', Broadcast: ' + self.broadcast() + '\r\n'
+                if time.time() >= self.leaseAt else ''))
+        elif command.startswith('show version'):
+            return ('fpc0:\r\n--------------------------------------------------------------------------\r\n'
+                'Hostname: ' + self.hostname() + '\r\nModel: ' + self.model.lower() + '\r\n'
+                'JUNOS Base OS boot [12.3R6.6]\r\n')
+        elif command.startswith('show configuration'):
+            return '\r\n'.join(self.active) + '\r\n'
+        elif command.startswith('show system commit'):
+            return ''.join(['%d   2014-03-13 07:00:00 UTC by root via cli\r\n' % index for index in range(len(self.history) + 1)])
+        return ''
+
+    def showXml(self, command):
+        '''The "| display xml" form of the show commands switchpick parses'''
+        if command.startswith('show chassis hardware'):
+            body = ('    <chassis-inventory xmlns="http://xml.juniper.net/junos/12.3R6/junos-chassis">\r\n'
+                '        <chassis junos:style="inventory">\r\n'
+                '            <name>Chassis</name>\r\n'
+                '            <serial-number>' + self.serialNumber + '</serial-number>\r\n'
+                '            <description>' + self.model + '</description>\r\n'
+                '            <chassis-module>\r\n'
+                '                <name>Routing Engine 0</name>\r\n'
+                '                <version>REV 10</version>\r\n'
+                '                <part-number>750-026468</part-number>\r\n'
+                '                <serial-number>' + self.serialNumber + '</serial-number>\r\n'
+                '                <description>' + self.model + '</description>\r\n'
+                '            </chassis-module>\r\n'
+                '        </chassis>\r\n'
+                '    </chassis-inventory>\r\n')
+        elif command.startswith('show interfaces vlan'):
+            address = ('                    <interface-address>\r\n'
+                '                        <ifa-destination>' + self.subnet + '</ifa-destination>\r\n'
+                '                        <ifa-local>' + self.address + '</ifa-local>\r\n'
+                '                        <ifa-broadcast>' + self.broadcast() + '</ifa-broadcast>\r\n'
+                '                    </interface-address>\r\n') if time.time() >= self.leaseAt else ''
+            body = ('    <interface-information xmlns="http://xml.juniper.net/junos/12.3R6/junos-interface" junos:style="normal">\r\n'
+                '        <physical-interface>\r\n'
+                '            <name>vlan</name>\r\n'
+                '            <admin-status junos:format="Enabled">up</admin-status>\r\n'
+                '            <current-physical-address>' + self.mac + '</current-physical-address>\r\n'
+                '            <hardware-physical-address>' + self.mac + '</hardware-physical-address>\r\n'
+                '            <logical-interface>\r\n'
+                '                <name>vlan.0</name>\r\n'
+                '                <address-family>\r\n'
+                '                    <address-family-name>inet</address-family-name>\r\n'
+                + address +
+                '                </address-family>\r\n'
+                '            </logical-interface>\r\n'
+                '        </physical-interface>\r\n'
+                '    </interface-information>\r\n')
+        else:
+            body = '    <output>\r\n' + self.show(command).replace('&', '&amp;').replace('<', '&lt;') + '    </output>\r\n'
+        return ('<rpc-reply xmlns:junos="http://xml.juniper.net/junos/12.3R6/junos">\r\n' + body +
+            '    <cli>\r\n        <banner>{master:0}</banner>\r\n    </cli>\r\n</rpc-reply>\r\n')
+
+    def pipe(self, output, pipes):
+        lines = output.split('\r\n')
+        for pipe in pipes:
+            words = pipe.split(None, 1)
+            if words == []:
+                continue
+            argument = words[1].strip('"') if len(words) > 1 else ''
+            if words[0] == 'match':
+                lines = [line for line in lines if argument.lower() in line.lower()]
+            elif words[0] == 'except':
+                lines = [line for line in lines if argument.lower() not in line.lower()]
+            elif words[0] == 'find':
+                found = [index for index in range(len(lines)) if argument.lower() in lines[index].lower()]
+                lines = lines[found[0]:] if found else []
+            elif words[0] == 'count':
+                return 'Count: %d lines\r\n' % len([line for line in lines if line])
+            elif words[0] == 'save':
+                self.store(self.resolve(argument), '\n'.join(lines))
+                return 'Wrote %d lines of output to \'%s\'\r\n' % (len(lines), argument)
+        return '\r\n'.join(lines).strip('\r\n') + ('\r\n' if lines else '')
+
+    def hostname(self):
+        for line in self.active:
+            if line.startswith('set system host-name '):
+                return line.split()[-1]
+            if line.strip().startswith('host-name '):
+                return line.split()[-1].rstrip(';')
+        return ''
+
+    def broadcast(self):
+        return self.address.rsplit('.', 1)[0] + '.255'
+
+    def confirm(self, question, action):
+        self.state = 'confirm'
+        self.confirmAction = action
+        self.out(question)
+        return
+
+    def confirmLine(self, line):
+        action, self.confirmAction = self.confirmAction, None
+        if line.strip().lower() in ('yes', 'y') or (line.strip() == '' and action == self.leaveConfiguration):
+            action()
+        elif action == self.leaveConfiguration:
+            self.state = 'configuration'
+            self.respond('')
+        else:
+            self.state = 'operational'
+            self.respond('')
+        return
+
+    ############################################################################
+    #   Configuration mode (#)
+    ############################################################################
+
+    def enterConfiguration(self):
+        self.state = 'configuration'
+        self.candidate = list(self.active)
+        self.generation += 1
+        session = self.generation
+        if self.autoUpdating() and (self.random.random() < self.autoUpdate):
+            def drop():
+                if (self.generation == session) and (self.state in ('configuration', 'terminal')):
+                    self.line = ''
+                    self.state = 'shell'
+                    self.out('\r\n\r\nerror: unexpectedly closed connection\r\n' + SHELL_PROMPT)
+            self.later(self.random.uniform(0.5, 5.0), drop)
+        self.respond('Entering configuration mode\r\n')
+        return
+
+    def autoUpdating(self):
+        return any(['auto-image-upgrade' in line for line in self.active])
+
+    def configLine(self, line):
+        words = line.split()
+        command = ' '.join(words)
+        if command == '':
+            self.respond('')
+        elif command in ('exit', 'quit', 'exit configuration-mode'):
+            if self.candidate != self.active:
+                self.confirm('The configuration has been changed but not committed\r\n'
+                    'Exit with uncommitted changes? [yes,no] (yes) ', self.leaveConfiguration)
+            else:
+                self.leaveConfiguration()
+        elif command in ('top', 'up'):
+            self.respond('')
+        elif command == 'load factory-default':
+            self.candidate = list(FACTORY_DEFAULT)
+            self.respond('warning: activating factory configuration\r\n')
+        elif (len(words) == 3) and (words[0] == 'load') and (words[2] == 'terminal'):
+            self.state, self.loadMode, self.loadLines = 'terminal', words[1], []
+            self.out('[Type ^D at a new line to end input]\r\n')
+        elif (len(words) == 3) and (words[0] == 'load') and (words[1] in ('override', 'merge', 'replace', 'set')):
+            path = self.resolve(words[2])
+            if path in self.contents:
+                self.candidate = self.applyLoad(words[1], self.contents[path].split('\n'))
+                self.respond('load complete\r\n')
+            else:
+                self.respond('error: Could not open configuration file: ' + words[2] + '\r\nload failed\r\n')
+        elif words[:1] == ['set']:
+            self.candidate.append(command)
+            self.respond('')
+        elif words[:1] == ['delete']:
+            self.respond('' if self.delete(command) else 'warning: statement not found\r\n')
+        elif words[:1] == ['rollback']:
+            index = int(words[1]) if len(words) > 1 else 0
+            self.candidate = list(self.active if index == 0 else self.history[index - 1])
+            self.respond('load complete\r\n')
+        elif words[:1] == ['commit']:
+            self.commit(words[1:])
+        elif words[:3] == ['run', 'file', 'delete']:
+            self.respond(self.deleteFile(words[-1]))
+        elif words[:1] in (['show'], ['run'], ['edit']):
+            self.respond('')
+        else:
+            self.respond('syntax error.\r\n')
+        return
+
+    def leaveConfiguration(self):
+        self.state = 'operational'
+        self.respond('Exiting configuration mode\r\n')
+        return
+
+    def delete(self, command):
+        path = 'set' + command[len('delete'):]
+        kept = [line for line in self.candidate if not (line == path or line.startswith(path + ' '))]
+        found = len(kept) != len(self.candidate)
+        self.candidate = kept
+        return found
+
+    def terminalLine(self, line):
+        self.loadLines.append(line)
+        if self.parseDelay:     #A slow CLI parse lets type-ahead pile up
+            self.busy = True
+            self.later(self.parseDelay, self.ready)
+        return
+
+    def finishLoad(self):
+        self.candidate = self.applyLoad(self.loadMode, self.loadLines)
+        self.loadLines = []
+        self.state = 'configuration'
+        self.respond('\r\nload complete\r\n')
+        return
+
+    def applyLoad(self, mode, lines):
+        if mode == 'override':
+            return [line for line in lines if line.strip()]
+        candidate = list(self.candidate)
+        for line in lines:
+            line = ' '.join(line.split())
+            if line.startswith('delete '):
+                self.candidate = candidate
+                self.delete(line)
+                candidate = self.candidate
+            elif line:
+                candidate.append(line)
+        return candidate
+
+    def commit(self, options):
+        confirmed = ('confirmed' in options)
+        quit = ('and-quit' in options)
+        check = ('check' in options)
+        minutes = 10
+        if confirmed:
+            index = options.index('confirmed') + 1
+            if (index < len(options)) and options[index].isdigit():
+                minutes = int(options[index])
+
+        def finish():
+            text = '\r\n'.join(self.candidate)
+            if 'root-authentication' not in text:
+                self.state = 'configuration'
+                self.out('[edit]\r\n  \'system\'\r\n    Missing mandatory statement: \'root-authentication\'\r\n'
+                    'error: configuration check-out failed\r\nerror: commit failed: (missing mandatory statements)\r\n')
+                return
+            if check:
+                self.out('configuration check succeeds\r\n')
+                return
+            self.history.insert(0, list(self.active))
+            self.active = list(self.candidate)
+            self.leaseAt = time.time() + self.leaseTime     #A new config restarts DHCP
+            self.rollbackTimer += 1
+            if confirmed:
+                self.out('commit confirmed will be automatically rolled back in %d minutes unless confirmed\r\n' % minutes)
+                timer = self.rollbackTimer
+                self.later(minutes * 60, lambda: self.autoRollback(timer))
+            self.out('commit complete\r\n')
+            self.out(self.applySpeed)
+            if quit:
+                self.state = 'operational'
+                self.out('Exiting configuration mode\r\n')
+        self.respond('', after=self.commitTime, then=finish)
+        return
+
+    def autoRollback(self, timer):
+        if timer != self.rollbackTimer:
+            return      #Confirmed by a later commit
+        self.active = self.history.pop(0)
+        self.candidate = list(self.active)
+        self.out('\r\nBroadcast Message from root@ (no tty) at 7:00 UTC...\r\n\r\n'
+            'Commit was not confirmed; automatic rollback complete.\r\n\r\n')
+        self.out(self.applySpeed)
+        return
+
+    def applySpeed(self):
+        speed = 9600
+        for line in self.active:
+            words = line.split()
+            if words[:5] == ['set', 'system', 'ports', 'console', 'speed'] and len(words) > 5:
+                speed = int(words[5])
+        self.speed = speed
+        return
+
+    ############################################################################
+    #   Power, boot and the loader
+    ############################################################################
+
+    def boot(self, single=False):
+        '''Run the boot sequence from power-on to a login (or single user) prompt'''
+        self.generation += 1
+        boot = self.generation
+        self.state, self.line, self.busy, self.typeahead = 'booting', '', False, ''
+        def step(text, state=None):
+            def show():
+                if boot != self.generation:
+                    return
+                self.out(text)
+                if state is not None:
+                    self.state = state
+            return show
+        countdown = 0 if single else COUNTDOWN
+        for fraction, text in BOOT_MESSAGES:
+            if 'space bar' in text:
+                if not single:
+                    self.later(fraction * self.bootTime, step(text, 'countdown'))
+                    self.later(fraction * self.bootTime + countdown, step('', 'booting'))
+            elif (fraction > 0.05) or not single:
+                self.later(fraction * self.bootTime + (countdown if fraction > 0.05 else 0), step(text))
+        if single:
+            self.later(self.bootTime, step('\r\nEnter full pathname of shell or \'recovery\' for root password recovery or RETURN for /bin/sh: ', 'single'))
+        else:
+            self.later(self.bootTime + countdown, step('\r\n' + (self.hostname() or 'Amnesiac') + ' (ttyu0)\r\n\r\nlogin: ', 'login'))
+        return
+
+    def powerCycle(self):
+        '''Pull the power cord and plug it back in'''
+        self.boot()
+        return
+
+    def attachUsb(self):
+        '''Plug a USB drive into the switch, the kernel reports it on the console'''
+        self.usb = True
+        self.files['/dev'].update([self.usbDisk, self.usbDisk + 's1'])
+        self.out('umass1: <SanDisk Cruzer Blade, class 0/0, rev 2.00/1.00, addr 3> on uhub1\r\n'
+            + self.usbDisk + ' at umass-sim1 bus 1 target 0 lun 0\r\n'
+            + self.usbDisk + ': <SanDisk Cruzer Blade 1.00> Removable Direct Access SCSI-6 device\r\n')
+        return
+
+    def unplug(self):
+        '''Pull the console cable, nothing is heard or answered until plug()'''
+        self.generation += 1
+        self.state, self.line, self.busy, self.typeahead = 'unplugged', '', False, ''
+        self.tx, self.events = [], []
+        return
+
+    def plug(self, serialNumber, mac=None):
+        '''Cable in another switch, fresh from the box and booting'''
+        self.serialNumber, self.mac = serialNumber, (mac or self.mac)
+        self.active, self.candidate, self.history = list(FACTORY_DEFAULT), list(FACTORY_DEFAULT), []
+        self.user, self.parents = self.username, []
+        self.leaseAt = time.time() + self.leaseTime
+        self.boot()
+        return
+
+    def shutdown(self, then):
+        self.generation += 1
+        shutdown = self.generation
+        self.state = 'shutdown'
+        self.out(SHUTDOWN_MESSAGE)
+        def finish():
+            if shutdown == self.generation:
+                self.out(SYNC_MESSAGE)
+                then()
+        self.later(self.haltTime, finish)
+        return
+
+    def reboot(self):
+        self.shutdown(lambda: (self.out('Rebooting...\r\n'), self.boot()))
+        return
+
+    def halt(self):
+        def halted():
+            self.state = 'halted'
+            self.out('The operating system has halted.\r\nPlease press any key to reboot.\r\n\r\n')
+        self.shutdown(halted)
+        return
+
+    def loaderLine(self, line):
+        words = line.split()
+        if words[:1] == ['boot']:
+            self.boot(single=('-s' in words))
+        else:
+            self.out(LOADER_PROMPT)
+        return
+
+    def singleLine(self, line):
+        if line.strip() == 'recovery':
+            self.user, self.parents = 'root', ['login']
+            self.state = 'operational'
+            self.respond('NOTE: Once in the CLI, you will need to enter configuration mode using\r\n'
+                'NOTE: the \'configure\' command to make any required changes.\r\n', after=self.recoveryTime)
+        else:
+            self.state, self.parents = 'shell', ['login']
+            self.respond('')
+        return
+
+
+
+################################################################################
+#                                      Function Calls
+################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description='Emulate a JUNOS serial console on a pseudo-terminal')
+    parser.add_argument('--model', default='EX2200-24T-4G')
+    parser.add_argument('--serial', default='CW0211270001', help='chassis serial number')
+    parser.add_argument('--password', default='root')
+    parser.add_argument('--delay', type=float, default=0.05, help='seconds before each prompt')
+    parser.add_argument('--commit-time', type=float, default=3.0)
+    parser.add_argument('--boot-time', type=float, default=20.0)
+    parser.add_argument('--loss', type=float, default=0.0, help='chance of losing any single byte')
+    parser.add_argument('--auto-update', type=float, default=0.0, help='chance Auto-Update closes a config session')
+    parser.add_argument('--baud', type=int, default=9600, help='line rate to pace bytes at while the console runs at 9600, scaled with a faster console speed, 0 for unlimited')
+    parser.add_argument('--lease-time', type=float, default=0.0, help='seconds after a commit before DHCP gives the vlan an address')
+    parser.add_argument('--usb-disk', default='da1', help='disk name the USB drive attaches as')
+    parser.add_argument('--usb-delay', type=float, default=0.0, help='seconds before a USB drive is plugged in')
+    parser.add_argument('--state', default='login', choices=['login', 'shell', 'operational', 'off'])
+    arguments = parser.parse_args()
+
+    switch = JunosConsole(model=arguments.model, serialNumber=arguments.serial,
+        password=arguments.password, delay=arguments.delay, commitTime=arguments.commit_time,
+        bootTime=arguments.boot_time, loss=arguments.loss, autoUpdate=arguments.auto_update,
+        baud=arguments.baud, leaseTime=arguments.lease_time, usbDisk=arguments.usb_disk, usbDelay=arguments.usb_delay, state=('halted' if arguments.state == 'off' else arguments.state))
+    print('JUNOS console emulator on: ' + switch.start())
+    print('Ctrl-C to stop')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        switch.stop()
+    return
+
+if __name__ == '__main__':
+    main()
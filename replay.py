@@ -0,0 +1,205 @@
+'''
+
+    SwitchPick Replay
+        for SwitchPick for JUNOS
+
+Feeds a console transcript recorded by switchpick.py back through its workflows, so a
+run that went wrong in the field can be repeated at a desk and parser or timing changes
+can be tried against real switch output. Received bytes are released in their recorded
+order, each one only after the workflow has made every write that preceded it and, unless
+--speed is 0, after the recorded gap (divided by --speed) has passed.
+
+    python replay.py assets/transcripts/dev-ttyUSB0.spt --list
+    python replay.py assets/transcripts/dev-ttyUSB0.spt --run 3 --speed 10 --config custom.txt
+
+'''
+
+
+################################################################################
+#                                      Imports / Constants
+################################################################################
+
+import os, sys, time
+import tempfile, shutil
+import argparse
+
+import switchpick
+
+
+#Workflow span names written as transcript markers, and how to run each again
+WORKFLOWS = {
+    'config_load': lambda arguments: switchpick.applyConfig(arguments.config),
+    'log_grab': lambda arguments: switchpick.collectLogs(arguments.stream),
+    'wipe': lambda arguments: switchpick.wipeSettings(arguments.loader),
+    'power_off': lambda arguments: switchpick.haltSwitch(),
+    'reboot': lambda arguments: switchpick.restartSwitch(),
+    }
+
+
+
+################################################################################
+#                                      Transcripts
+################################################################################
+
+class TranscriptEnded(Exception):
+    '''The workflow waited for console output past the end of the recording'''
+    pass
+
+
+def loadRuns(paths):
+    '''Split the records of one or more transcript files into runs, one per workflow marker'''
+    runs = []
+    for path in paths:
+        for stamp, kind, data in switchpick.readTranscript(path):
+            if kind == 'M':
+                runs.append({'name': data, 'start': stamp, 'records': []})
+            elif runs:      #Traffic before the first marker belongs to no workflow
+                runs[-1]['records'].append((stamp, kind, data))
+    return runs
+
+
+def listRuns(runs):
+    for index, run in enumerate(runs):
+        records = run['records']
+        length = (records[-1][0] - run['start']) if records else 0.0
+        received = sum([len(data) for stamp, kind, data in records if kind == 'R'])
+        sent = sum([len(data) for stamp, kind, data in records if kind == 'T'])
+        print('%4d  %s  %-12s %8.1fs  %d/%d bytes in/out' % (index, time.strftime('%Y-%m-%d %H:%M:%S',
+            time.localtime(run['start'])), run['name'], length, received, sent))
+    return
+
+
+class ReplayConsole(object):
+    '''
+    Stands in for the serial port. Received records wait on the workflow - switchpick
+    records each write as one transmitted record, so a received record is due once the
+    workflow has made as many writes as came before it, plus its recorded delay after
+    the previous record. Writes that differ from the recording are counted, not enforced.
+    '''
+    def __init__(self, run, speed):
+        self.records = run['records']
+        self.speed = speed
+        self.index = 0
+        self.pending = ''
+        self.sent = [data for stamp, kind, data in self.records if kind == 'T']
+        self.writes = 0
+        self.expected = 0       #Recorded writes the workflow has caught up with
+        self.mark = time.time()     #Replay time and recorded time of the last released record
+        self.writeTime = self.mark
+        self.markStamp = run['start']
+        self.timeout = None
+        self.baudrate = switchpick.DEFAULT_BAUDRATE
+        self.mismatches = 0
+
+    def advance(self):
+        '''Release every record that is due, returns the next due time or None if gated'''
+        now = time.time()
+        while self.index < len(self.records):
+            stamp, kind, data = self.records[self.index]
+            if kind == 'T':
+                if (self.writes <= self.expected):
+                    return None
+                self.expected += 1
+                self.mark, self.markStamp = max(self.mark, self.writeTime), stamp
+            else:
+                due = (self.mark + (stamp - self.markStamp) / self.speed) if self.speed else now
+                if now < due:
+                    return due
+                self.pending += data
+                self.mark, self.markStamp = due, stamp
+            self.index += 1
+        return None
+
+    def inWaiting(self):
+        self.advance()
+        return len(self.pending)
+
+    def read(self, size=1):
+        deadline = time.time() + (self.timeout or 0)
+        while True:
+            due = self.advance()
+            if self.pending:
+                data, self.pending = self.pending[:size], self.pending[size:]
+                return data
+            if (self.index >= len(self.records)):
+                raise TranscriptEnded(' > '.join(switchpick.session().spans) or '(no phase)')
+            now = time.time()
+            if now >= deadline:
+                return ''
+            time.sleep(max(0.0, min(deadline, due or deadline) - now))
+
+    def write(self, data):
+        if (self.writes >= len(self.sent)) or (data != self.sent[self.writes]):
+            self.mismatches += 1
+        self.writes += 1
+        self.writeTime = time.time()
+        return len(data)
+
+    def flush(self):
+        return
+
+    def close(self):
+        return
+
+
+
+################################################################################
+#                                      Function Calls
+################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a switchpick console transcript through its workflows')
+    parser.add_argument('transcripts', nargs='+', help='transcript files, oldest first (e.g. x.spt.2 x.spt.1 x.spt)')
+    parser.add_argument('--list', action='store_true', help='list the recorded workflow runs and exit')
+    parser.add_argument('--run', type=int, default=-1, help='index of the run to replay, the last one by default')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed factor, 0 for as fast as possible')
+    parser.add_argument('--config', default=switchpick.GENERAL_CONFIG, help='config file for config_load runs')
+    parser.add_argument('--loader', action='store_true', help='wipe runs used the loader')
+    parser.add_argument('--stream', action='store_true', help='log runs streamed the files back')
+    parser.add_argument('--verbose', action='store_true', help='show switchpick output')
+    arguments = parser.parse_args()
+
+    runs = loadRuns(arguments.transcripts)
+    if not runs:
+        parser.error('no workflow runs recorded in ' + ', '.join(arguments.transcripts))
+    if arguments.list:
+        listRuns(runs)
+        return
+    run = runs[arguments.run]
+    if run['name'] not in WORKFLOWS:
+        parser.error('cannot replay a ' + run['name'] + ' run')
+
+    #Replays leave the real transcripts, provisioning records and timing logs alone
+    scratch = tempfile.mkdtemp()
+    switchpick.TRANSCRIPT_ON = False
+    switchpick.PROVISIONING_DB = os.path.join(scratch, 'deployments.db')
+    switchpick.TIMING_LOG = os.path.join(scratch, 'timing.jsonl')
+    switchpick.TIMING_METRICS = os.path.join(scratch, 'switchpick.prom')
+    switchpick.LOG_DIRECTORY = os.path.join(scratch, 'logs')
+    switchpick.loadCredentials()
+    console = ReplayConsole(run, arguments.speed)
+    switchpick.bindSession(switchpick.Session(console, 'replay'))
+
+    print('Replaying %s run from %s at %s...' % (run['name'], time.strftime('%Y-%m-%d %H:%M:%S',
+        time.localtime(run['start'])), ('%gx' % arguments.speed) if arguments.speed else 'full speed'))
+    stdout = sys.stdout
+    if not arguments.verbose:
+        sys.stdout = open(os.devnull, 'w')
+    start = time.time()
+    try:
+        result = WORKFLOWS[run['name']](arguments)
+        outcome = 'finished, returned ' + repr(result)
+    except TranscriptEnded as reason:
+        outcome = 'ran out of transcript in ' + str(reason)
+    except Exception as reason:
+        outcome = 'failed: ' + str(reason)
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(scratch)
+    print('Workflow %s after %.1fs' % (outcome, time.time() - start))
+    print('Replayed %d of %d records, %d writes differed from the recording' % (console.index,
+        len(console.records), console.mismatches))
+    return
+
+if __name__ == '__main__':
+    main()
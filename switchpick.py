@@ -16,10 +16,130 @@ This automates the procedure so that configurations can be loaded without touchi
 import serial
 import sys, os
 import time
+import threading
+import select, errno
+import glob, fnmatch, Queue
+import argparse
+import sqlite3, csv
+import xml.etree.ElementTree as ElementTree
+import hashlib, re
+import json, struct, collections
+import base64, gzip, io
+try:
+    from serial.tools import list_ports     #Not in very old pyserial releases
+except ImportError:
+    list_ports = None
+try:
+    import fcntl    #POSIX only, the console reactor is unavailable without it
+except ImportError:
+    fcntl = None
 
 
-CONSOLE = ''        #Our serial connection will be a global value
+SESSIONS = threading.local()    #Each thread drives its own console session
 READ_TIMEOUT = 8
+PULL_INTERVAL = 1       #Seconds between newlines when pulling a prompt
+LOGIN_WAIT = 15         #Seconds of silence before nudging an unknown prompt
+BUFFER_LIMIT = 65536    #Rolling console buffer, oldest bytes are dropped first
+FLEET_REFRESH = 5   #Seconds between fleet status checks
+DEFAULT_BAUDRATE = 9600
+FAST_BAUDRATE = 115200  #Console speed used for bulk config transfers
+FAST_TRANSFER = False   #Toggled from the config menu
+UPSHIFT_ROLLBACK = 2    #Minutes before JUNOS reverts an unconfirmed speed change
+LINK_PROBE = 10         #Seconds to wait for a prompt after changing speed
+PASTE_WINDOW = 128      #Config bytes typed before waiting for their echo, adapts between the limits below
+PASTE_MIN = 16
+PASTE_MAX = 384         #The console starts dropping data at around 400-500 buffered bytes
+PASTE_STEP = 16         #Window growth per line that echoes cleanly, failures halve it
+PASTE_RETRIES = 3       #Times a garbled config line is erased and typed again
+ECHO_TIMEOUT = 2        #Seconds without echo before a typed window counts as lost
+LOAD_TIMEOUT = 120      #Seconds JUNOS may take to parse a loaded terminal
+CONFIG_TRANSFER = 'paste'   #Toggled from the config menu: 'paste' to a load terminal or 'upload' a compressed file
+STAGE_FILE = '/var/tmp/switchpick-load.conf'   #Uploaded configs are loaded from here
+CONFIG_SETTLE = 6       #Seconds Auto-Update may still close a new config session
+CONFIG_PROBE = 1        #Seconds between empty lines sent to a settling config session
+DISABLE_AUTO_UPDATE = False     #Toggled from the config menu, removed with the factory-default commit
+COMMIT_TIMEOUT = 300    #Seconds a commit may run before it is treated as hung
+COMMIT_CHECK = False    #Toggled from the config menu, "commit check" before committing loaded configs
+SINGLE_COMMIT = False   #Toggled from the config menu, password and loaded config in one commit
+FAST_PATH = 'skip'      #Toggled from the config menu: 'off', 'skip' configs already applied, or 'delta' loads too
+DELTA_LIMIT = 0.25      #Largest share of a set config that a delta load may change
+CHECKSUM_FILE = '/var/tmp/switchpick.set'   #Scratch copy of the active config, hashed on the switch
+DHCP_TIMEOUT = 20       #Seconds to wait for the vlan to lease an address after a config load
+DHCP_POLL = 2           #Seconds between checks for the lease
+LOG_TIMEOUT = 600       #Seconds RSI generation and log archiving may take together
+WIPE_TARGETS = [      #Configs and config databases a wipe removes, by directory
+    ('/config', ['juniper.conf.gz', 'juniper.conf.*.gz', 'rescue.conf.gz']),
+    ('/var/run/db', ['juniper.db', 'juniper.data', 'juniper.save']),
+    ('/var/tmp', ['switchpick.set', 'switchpick-load.conf*']),     #CHECKSUM_FILE and STAGE_FILE, if a run was cut short
+    ]
+DRIVE_TIMEOUT = 120     #Seconds to wait for a USB drive to be plugged into the switch
+DRIVE_POLL = 10         #Seconds between device list checks if the kernel reports nothing
+SHELL_MARKER = 'SWITCHPICK'     #Echoed around shell output, typed with quotes so the echo of the line never matches
+STREAM_RETRIES = 2      #Extra attempts at a streamed file that fails its checksum
+FLEET_REACTOR = True    #Fleet consoles share one select() reactor thread (POSIX only)
+FLEET_STACK = 512*1024  #Worker thread stack size, workers spend their life parked
+CONVEYOR_PROBE = 5      #Seconds between checks for a switch being unplugged or cabled in
+UNPLUG_PROBES = 3       #Unanswered checks in a row before a switch counts as unplugged
+CONVEYOR_ACTIONS = ['wipe', 'prime', 'custom', 'gather', 'reboot', 'power-off']
+BOOT_MILESTONES = [     #(console texts, milestone) in the order a reboot prints them
+    (['System going down'], 'shutting down'),
+    (['syncing disks'], 'disks synced'),
+    (['U-Boot', 'Hit [Enter] to boot'], 'loader started'),
+    (['Kernel entry', 'Juniper Networks, Inc.'], 'kernel started'),
+    (['mgd:', 'management process'], 'management process started'),
+    (['Local package initialization', 'Interfaces up'], 'interfaces up'),
+    (['login:'], 'login prompt'),
+    ]
+HALT_MILESTONES = [(['System going down'], 'shutting down'), (['syncing disks'], 'disks synced'),
+    (['press any key to reboot.'], 'halted')]
+BOOT_TIMEOUT = 900      #Seconds a reboot may take to reach the login prompt without a timing profile
+HALT_TIMEOUT = 300      #Seconds a power-off may take to halt without a timing profile
+PROGRESS_INTERVAL = 15  #Seconds between progress lines while nothing new shows up in a boot
+REACTOR = None          #Started on first use
+CONFIG_HIERARCHIES = set([      #Top level statements a loaded config may use
+    'version', 'groups', 'apply-groups', 'apply-groups-except', 'system', 'chassis', 'services', 'security',
+    'interfaces', 'snmp', 'forwarding-options', 'event-options', 'routing-options', 'protocols',
+    'policy-options', 'class-of-service', 'firewall', 'routing-instances', 'vlans', 'ethernet-switching-options',
+    'switch-options', 'poe', 'virtual-chassis', 'access', 'access-profile', 'accounting-options', 'applications',
+    'bridge-domains', 'multi-chassis', 'fabric', 'dynamic-profiles', 'logical-systems', 'smtp', 'schedulers',
+    ])
+SET_COMMANDS = ['set', 'delete', 'activate', 'deactivate', 'annotate', 'insert', 'rename', 'copy',
+    'protect', 'unprotect', 'edit', 'top', 'up', 'exit']   #Configuration mode commands a set load accepts
+MANAGEMENT_INTERFACES = ['me0', 'vme', 'em0', 'fxp0']   #Out-of-band management ports, by platform
+TEMPLATE_FIELDS = re.compile(r'\$\{([A-Za-z_][A-Za-z0-9_-]*)\}')   #${name}, JUNOS itself never writes ${
+TEMPLATE_CACHE = collections.OrderedDict()    #Template text hash -> compiled template, least recently used first
+TEMPLATE_CACHE_SIZE = 8     #Compiled templates kept, an edited template pushes out its old copy in time
+TEMPLATE_LOCK = threading.Lock()
+CONFIG_TOKENS = re.compile(r'"(?:[^"\\]|\\.)*"|/\*.*?\*/|/\*|#[^\n]*|[{};\[\]]|"|[^\s{};\[\]"]+', re.S)
+
+#Fallback port list, used when pyserial can't enumerate devices
+SERIAL_PORTS = [
+    #Windows COM ports
+    'COM9', 'COM8', 'COM7',
+    'COM6', 'COM5', 'COM4',
+    'COM3', 'COM2', 'COM1',
+    #ARM/RPI Port
+    '/dev/ttyUSB0',
+    #Linux/Unix Ports
+    '/dev/ttyS0', '/dev/ttyS1',
+    '/dev/ttyS2', '/dev/ttyS3'
+    ]
+PORT_PATTERNS = ['/dev/ttyUSB*', '/dev/ttyACM*', '/dev/serial/by-id/*', '/dev/ttyS[0-3]']
+CONSOLE_PROMPTS = ['login:', '%', '>', '#', '}']     #'>' also covers loader>
+PROBE_WAIT = 1.5        #Seconds a port gets to show a JUNOS prompt
+HOTPLUG_INTERVAL = 1    #Seconds between device scans
+HOTPLUG_RETRY = 10      #Seconds to wait for a new device before probing again
+PORT_WATCHER = None
+#How each console state prompts - the end of the prompt, so "{master:0}" lines don't count
+PROMPT_STATES = [
+    ('loader>', 'loader'),
+    ('login:', 'login'),
+    ('word:', 'password'),
+    ('[yes,no]', 'confirm'),
+    ('# ', 'configuration'),
+    ('% ', 'shell'),
+    ('> ', 'operational'),
+    ]
 
 
 USERNAME = ''
@@ -28,7 +148,24 @@ ENCRYPTED_PASSWORD = ''
 
 CREDENTIAL_FILE = os.path.join(os.path.dirname(sys.argv[0]), 'assets', 'credentials.txt')
 GENERAL_CONFIG = os.path.join(os.path.dirname(sys.argv[0]), 'assets', 'prime.config')
-PROVISIONING_LOG = os.path.join(os.path.dirname(sys.argv[0]), 'assets', 'deployments.csv')
+PROVISIONING_LOG = os.path.join(os.path.dirname(sys.argv[0]), 'assets', 'deployments.csv')    #Legacy log, now the export
+PROVISIONING_DB = os.path.join(os.path.dirname(sys.argv[0]), 'assets', 'deployments.db')
+PROVISIONING_TIMEOUT = 30   #Seconds a writer waits on another worker's transaction
+TIMING_LOG = os.path.join(os.path.dirname(sys.argv[0]), 'assets', 'timing.jsonl')     #One line per phase span
+TIMING_METRICS = os.path.join(os.path.dirname(sys.argv[0]), 'assets', 'switchpick.prom')   #Prometheus textfile collector
+TIMING_LOCK = threading.Lock()
+TIMING_TOTALS = {}      #(workflow, phase) -> [runs, failures, seconds, sleep, read, bytes in, bytes out]
+TRANSCRIPTS = os.path.join(os.path.dirname(sys.argv[0]), 'assets', 'transcripts')    #Console recordings
+LOG_DIRECTORY = os.path.join(os.path.dirname(sys.argv[0]), 'assets', 'logs')   #Streamed logs, a folder per switch serial
+TRANSCRIPT_ON = True
+TRANSCRIPT_LIMIT = 4*1024*1024  #Bytes per transcript file before it rotates
+TRANSCRIPT_KEEP = 4     #Rotated files kept per console, on top of the current one
+TRANSCRIPT_SECRET = '<redacted>\n'     #Recorded in place of passwords typed to the console
+PROFILE_HISTORY = 50    #Latest successful runs of a phase that a timing profile is built from
+PROFILE_MIN_RUNS = 5    #Runs needed before a profile replaces the fixed waits
+PROFILE_PERCENTILE = 95     #Wait budgets cover this share of past runs...
+PROFILE_MARGIN = 1.5    #...with this much headroom on top
+PROFILE_PENDING = 500   #Spans kept while the model of a switch isn't known yet
 
 
 ################################################################################
@@ -36,17 +173,31 @@ PROVISIONING_LOG = os.path.join(os.path.dirname(sys.argv[0]), 'assets', 'deploym
 ################################################################################
 
 def main():
+    parser = argparse.ArgumentParser(description='SwitchPick for JUNOS')
+    parser.add_argument('--port', help='console device to use instead of auto-detection')
+    parser.add_argument('--manifest', help='headless conveyor mode, run the jobs in this manifest on each switch cabled in')
+    parser.add_argument('--lint', nargs='+', metavar='PATH', help='check config files, or the configs in directories, and exit')
+    arguments = parser.parse_args()
+    
+    if arguments.lint:      #No switch needed
+        sys.exit(1 if lintPaths(arguments.lint) else 0)
+    if arguments.manifest:  #No menu and no prompts, runs until Ctrl-C
+        loadCredentials()
+        initializeProvisioningStore()
+        conveyor(arguments.manifest, arguments.port)
+        return
+    
     #Initialize Serial, Load Credentials, and generate a log file if necessary
-    initializeSerialPort()
+    watchPorts()
+    initializeSerialPort(arguments.port)
     loadCredentials()
-    if (os.path.exists(PROVISIONING_LOG) != True):
-        clearProvisioningLog()
+    initializeProvisioningStore()
     
     #Menu loop
     while True:
         try:
             menu()
-            choice = option(0, 5)
+            choice = option(0, 7)
         
             #CREDENTIAL MANAGER
             if choice == 1:
@@ -63,6 +214,12 @@ def main():
             #POWER OPTIONS
             elif choice == 5:
                 powerOptions()
+            #FLEET MODE
+            elif choice == 6:
+                fleet()
+            #PROVISIONING RECORDS
+            elif choice == 7:
+                provisioning()
             #EXIT SENTINEL
             elif choice == 0:
                 sys.exit()
@@ -83,49 +240,161 @@ def main():
 #                                      Initialization
 ################################################################################
 
-def initializeSerialPort():
+def initializeSerialPort(port=None):
     '''Loops until serial communication can be established'''
     print('-'*40)
     print('Auto-Initializing Serial Port: 9600 8-N-1')
-    global CONSOLE
-    ports = [
-        #Windows COM ports
-        'COM9', 'COM8', 'COM7',
-        'COM6', 'COM5', 'COM4', 
-        'COM3', 'COM2', 'COM1',
-        #ARM/RPI Port
-        '/dev/ttyUSB0',
-        #Linux/Unix Ports
-        '/dev/ttyS0', '/dev/ttyS1', 
-        '/dev/ttyS2', '/dev/ttyS3'
-        ]
-    index = 0
     errorPrinted = False
     while True:
-        try:
-            CONSOLE = serial.Serial(
-                port=ports[index],
-                baudrate=9600,
-                parity='N',
-                stopbits=1,
-                bytesize=8,
-                timeout=READ_TIMEOUT
-            )
-            if CONSOLE.isOpen():
-                print('\tConnected: ' + ports[index])
-                print(' .'*20)
+        if port is not None:    #Named on the command line, no probing
+            try:
+                console = openSerialPort(port)
                 break
-        except:
-            if (index == len(ports) - 1):
-                index = 0
-                if errorPrinted == False:
-                    print('\tUnable to connect, please reseat adapaters')
-                    print(' .'*20)
-                    errorPrinted == True    #Why print 12x errors?
-                    time.sleep(10)  #Loops until a successful connection can be established.
-            else:
-                index += 1
+            except Exception as reason:
+                print('\tUnable to open ' + port + ': ' + str(reason))
+                sys.exit()
+        live, silent = discoverPorts(first=True)
+        if live:
+            port, console = live[0]
+            break
+        elif silent:
+            #An adapter without a prompt - the switch may be off (loader wipes start this way)
+            port = silent[0]
+            console = openSerialPort(port)
+            print('\tNo prompt from ' + port + ', connected anyway - power on the switch')
+            break
+        if errorPrinted == False:
+            print('\tUnable to connect, please reseat adapaters')
+            print(' .'*20)
+            errorPrinted = True
+        watchPorts().changed.wait(HOTPLUG_RETRY)   #Loops until a device shows up
+        watchPorts().changed.clear()
+    bindSession(Session(console, port))
+    print('\tConnected: ' + port)
+    print(' .'*20)
+    return
+
+
+def openSerialPort(port):
+    '''Open a console port at 9600 8-N-1, raises if the port is unavailable'''
+    return serial.Serial(
+        port=port,
+        baudrate=DEFAULT_BAUDRATE,
+        parity='N',
+        stopbits=1,
+        bytesize=8,
+        timeout=READ_TIMEOUT
+    )
+
+
+def candidatePorts():
+    '''
+    List serial devices that could hold a console cable, one name per device.
+    Stable /dev/serial/by-id names win over the ttyUSBn they link to.
+    '''
+    ports = []
+    if list_ports is not None:
+        ports = [info[0] for info in list_ports.comports()]
+    if os.name == 'posix':
+        for pattern in PORT_PATTERNS:
+            ports += sorted(glob.glob(pattern))
+    elif ports == []:
+        ports = list(SERIAL_PORTS)
+    devices = {}
+    for port in ports:
+        device = os.path.realpath(port)
+        if (device not in devices) or ('/by-id/' in port):
+            devices[device] = port
+    return sorted(devices.values())
+
+
+def probePort(port, found):
+    '''Open a port and look for a JUNOS prompt, reports (port, console or None, opened)'''
+    console = None
+    try:
+        console = openSerialPort(port)
+        bindSession(Session(console, port))
+        writeSerial('\n')
+        if (expect(CONSOLE_PROMPTS, PROBE_WAIT) >= 0):
+            found.put((port, console, True))
+            return
+        console.close()
+        found.put((port, None, True))
+    except Exception:
+        if console is not None:
+            console.close()
+        found.put((port, None, False))
+    return
+
+
+def discoverPorts(first=False, exclude=()):
+    '''
+    Probe every candidate port at once. Returns consoles that answered with a prompt as
+    (port, console) pairs, plus the ports that opened but stayed silent.
+    With first=True it returns as soon as any console answers.
+    '''
+    excluded = [os.path.realpath(port) for port in exclude]
+    candidates = [port for port in candidatePorts() if os.path.realpath(port) not in excluded]
+    found = Queue.Queue()
+    for port in candidates:
+        probe = threading.Thread(target=probePort, args=(port, found), name='probe ' + port)
+        probe.daemon = True
+        probe.start()
+    live, silent = [], []
+    for answered in range(len(candidates)):
+        port, console, opened = found.get()
+        if console is not None:
+            live.append((port, console))
+            if first:
+                closer = threading.Thread(target=closeProbes, args=(found, len(candidates) - answered - 1))
+                closer.daemon = True
+                closer.start()
+                break
+        elif opened:
+            silent.append(port)
+    return sorted(live), sorted(silent)
+
+
+def closeProbes(found, remaining):
+    '''Close consoles from probes that finished after the caller stopped listening'''
+    for i in range(remaining):
+        console = found.get()[1]
+        if console is not None:
+            console.close()
     return
+
+
+class PortWatcher(object):
+    '''
+    Background scan for console adapters being plugged in or pulled out. Changes
+    are reported as they happen and signalled through the "changed" event.
+    '''
+    def __init__(self):
+        self.ports = set(candidatePorts())
+        self.changed = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='port watcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(HOTPLUG_INTERVAL)
+            ports = set(candidatePorts())
+            for port in sorted(ports - self.ports):
+                print('\n[Console adapter added: ' + port + ']')
+            for port in sorted(self.ports - ports):
+                print('\n[Console adapter removed: ' + port + ']')
+            if (ports != self.ports):
+                self.ports = ports
+                self.changed.set()
+
+
+def watchPorts():
+    '''Start the hot-plug watcher once'''
+    global PORT_WATCHER
+    if PORT_WATCHER is None:
+        PORT_WATCHER = PortWatcher()
+    return PORT_WATCHER
     
     
 def loadCredentials():
@@ -156,6 +425,11 @@ def loadCredentials():
         USERNAME = 'root'
         PASSWORD = 'root'
         ENCRYPTED_PASSWORD = ''
+    current = session()
+    if current is not None:
+        current.username = USERNAME
+        current.password = PASSWORD
+        current.encryptedPassword = ENCRYPTED_PASSWORD
     print('-'*40)
     return
     
@@ -167,15 +441,521 @@ def menu():
     print('SwitchPick for JUNOS - v 1.2')
     print('\tCode by Ryan Keller')
     print(' .'*20)
-    print('USER:\t\t' + USERNAME + '\nPASS:\t\t' + ('*' * len(PASSWORD)) + '\nEncryption:\t' + ('Loaded' if str(len(ENCRYPTED_PASSWORD)) > 1 else 'Not loaded'))
+    current = session()
+    print('PORT:\t\t' + current.port)
+    print('USER:\t\t' + current.username + '\nPASS:\t\t' + ('*' * len(current.password)) + '\nEncryption:\t' + ('Loaded' if str(len(current.encryptedPassword)) > 1 else 'Not loaded'))
     print('='*40)
     print('\t1) Update Credentials')
     print('\t2) Configuration')
     print('\t3) USB Log Grabber')
     print('\t4) Wipe Settings')
     print('\t5) Power Options')
+    print('\t6) Fleet Mode')
+    print('\t7) Provisioning Records')
+    print('='*40)
+    return
+    
+    
+    
+################################################################################
+#                                      Sessions
+################################################################################
+
+class Session(object):
+    '''
+    A console connection and the state that belongs to it. The menu drives a single
+    session, fleet mode runs one per serial port - each bound to its own thread.
+    '''
+    def __init__(self, console, port):
+        self.console = console
+        self.port = port
+        self.username = USERNAME
+        self.password = PASSWORD
+        self.encryptedPassword = ENCRYPTED_PASSWORD
+        self.status = 'Idle'
+        self.result = None
+        self.output = []
+        self.buffer = ''    #Console bytes read but not yet matched by expect()
+        self.before = ''    #Text preceding the last expect() match
+        self.state = None   #Prompt state last seen on the console, None when unknown
+        self.spans = []     #Names of the timing spans currently open
+        self.sleepTime = 0.0    #Running totals the spans take their share of
+        self.readTime = 0.0
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.transcript = Transcript(port) if TRANSCRIPT_ON else None
+        self.model = None   #Chassis model and JUNOS version, once read, pick the timing profile
+        self.version = None
+        self.samples = []   #(phase, seconds, ok, time) of spans not yet stored in the profile
+
+    def record(self, text):
+        '''Keep worker output, the latest meaningful line doubles as the port status'''
+        self.output.append(text)
+        lines = [line.strip() for line in text.split('\n') if line.strip(' \t\r-.=')]
+        if lines:
+            self.status = lines[-1]
+        return
+
+
+class FleetOutput(object):
+    '''
+    Stands in for stdout during fleet mode - fleet workers print into their own
+    session so ports don't interleave, everything else passes through
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+        self.softspace = 0
+
+    def write(self, text):
+        if getattr(SESSIONS, 'fleet', False):
+            session().record(text)
+        else:
+            self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class Transcript(object):
+    '''
+    Append-only recording of one console. After a 4 byte magic, every record is a
+    header of (time, kind, length) followed by the bytes - kind is R for received,
+    T for transmitted, or M marking the start of a workflow. The file rotates to
+    .1, .2 ... once it passes TRANSCRIPT_LIMIT bytes, keeping TRANSCRIPT_KEEP of them.
+    '''
+    MAGIC = 'SPT1'
+    HEADER = struct.Struct('<dcI')
+
+    def __init__(self, port):
+        self.path = os.path.join(TRANSCRIPTS, port.strip('/\\').replace('/', '-').replace('\\', '-') + '.spt')
+        self.file = None
+
+    def record(self, kind, data):
+        if (self.path is None):
+            return
+        try:
+            if (self.file is None):
+                self.open()
+            elif (self.file.tell() + self.HEADER.size + len(data) > TRANSCRIPT_LIMIT):
+                self.rotate()
+            self.file.write(self.HEADER.pack(time.time(), kind, len(data)) + data)
+            self.file.flush()   #A hung or killed run still leaves its last bytes behind
+        except (IOError, OSError) as reason:
+            print('Transcript disabled for ' + self.path + ': ' + str(reason))
+            self.path = None
+        return
+
+    def open(self):
+        if not os.path.isdir(TRANSCRIPTS):
+            os.makedirs(TRANSCRIPTS)
+        self.file = open(self.path, 'ab')
+        self.file.seek(0, 2)
+        if (self.file.tell() == 0):
+            self.file.write(self.MAGIC)
+        return
+
+    def rotate(self):
+        self.file.close()
+        for index in range(TRANSCRIPT_KEEP - 1, 0, -1):
+            if os.path.exists(self.path + '.' + str(index)):
+                os.rename(self.path + '.' + str(index), self.path + '.' + str(index + 1))
+        os.rename(self.path, self.path + '.1')
+        self.open()
+        return
+
+    def close(self):
+        if (self.file is not None):
+            self.file.close()
+            self.file = None
+        return
+
+
+def readTranscript(path):
+    '''Yield (time, kind, data) records from a transcript file, a torn last record ends it'''
+    file = open(path, 'rb')
+    try:
+        if (file.read(len(Transcript.MAGIC)) != Transcript.MAGIC):
+            raise Exception('Not a switchpick transcript: ' + path)
+        while True:
+            header = file.read(Transcript.HEADER.size)
+            if (len(header) < Transcript.HEADER.size):
+                break
+            stamp, kind, length = Transcript.HEADER.unpack(header)
+            data = file.read(length)
+            if (len(data) < length):
+                break
+            yield stamp, kind, data
+    finally:
+        file.close()
+
+
+def transcribe(kind, data):
+    '''Add console traffic (or a marker) to the transcript of the current session'''
+    current = session()
+    if (current is not None) and (current.transcript is not None):
+        current.transcript.record(kind, data)
+    return
+
+
+def session():
+    '''Return the session bound to the calling thread (None before initialization)'''
+    return getattr(SESSIONS, 'current', None)
+
+
+def bindSession(current):
+    '''Bind a session to the calling thread, all serial I/O goes through it'''
+    SESSIONS.current = current
+    return current
+
+
+def openFleet():
+    '''Open every live console port, reusing the port this thread already holds'''
+    sessions = [session()]
+    for port, console in discoverPorts(exclude=[session().port])[0]:
+        sessions.append(Session(console, port))
+    return sessions
+
+
+def fleetWorker(current, job):
+    '''Thread body for fleet mode, runs one job against one session'''
+    bindSession(current)
+    SESSIONS.fleet = True
+    current.status = 'Starting'
+    try:
+        if job():
+            current.result = 'Complete'
+        else:
+            current.result = 'Failed - see output'
+    except Exception as reason:
+        current.result = 'Failed - ' + str(reason)
+    return
+
+
+def fleetStatus(sessions):
+    '''Format a one line per port status table'''
+    lines = []
+    for current in sessions:
+        lines.append(current.port + '\t| ' + (current.result or current.status))
+    return '\n'.join(lines)
+
+
+def runFleet(sessions, job):
+    '''Start a worker thread per session and report status until every job finishes'''
+    stdout = sys.stdout
+    sys.stdout = FleetOutput(stdout)
+    if FLEET_REACTOR and reactorSupported():
+        attachReactor(sessions)
+    try:
+        workers = []
+        threading.stack_size(FLEET_STACK)
+        for current in sessions:
+            current.status, current.result, current.output = 'Queued', None, []
+            worker = threading.Thread(target=fleetWorker, args=(current, job), name=current.port)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        threading.stack_size(0)
+        shown = ''
+        while True:
+            table = fleetStatus(sessions)
+            if (table != shown):
+                print('-'*40)
+                print(table)
+                shown = table
+            running = [worker for worker in workers if worker.is_alive()]
+            if (running == []):
+                break
+            running[0].join(FLEET_REFRESH)
+    finally:
+        sys.stdout = stdout
+        detachReactor(sessions)
+    
+    print('='*40)
+    print('Fleet Results:')
+    print(' .'*20)
+    for current in sessions:
+        print(current.port + '\t| ' + current.result)
+        if (current.result != 'Complete'):
+            print(''.join(current.output)[-500:])
     print('='*40)
     return
+
+
+def openConveyor(port=None):
+    '''Open the named console port, or every serial device found - switches come and go later'''
+    sessions = []
+    for port in ([port] if port else candidatePorts()):
+        try:
+            sessions.append(Session(openSerialPort(port), port))
+        except Exception as reason:
+            print('\tUnable to open ' + port + ': ' + str(reason))
+    return sessions
+
+
+def conveyorWorker(current, jobs, position, progress):
+    '''
+    Thread body for conveyor mode. Runs the manifest job of each switch cabled to one
+    port, then waits for it to be unplugged and for the next one. Every change of job
+    goes to current.result and the progress queue.
+    '''
+    bindSession(current)
+    SESSIONS.fleet = True
+    def report(result):
+        current.result = result
+        progress.put((current.port, result))
+    last, halted = None, False
+    try:
+        while True:
+            report('Waiting for a switch')
+            awaitSwitch(halted)
+            current.output, halted = [], False
+            report('Identifying switch')
+            try:
+                serial = chassisSerial()
+                job = manifestJob(jobs, serial, current.port, position)
+                if (serial is None):
+                    report('Failed - serial number unreadable, swap switch')
+                elif (serial == last):  #Went quiet for a moment, it was never unplugged
+                    report(serial + ' | Complete - swap switch')
+                elif (job is None):
+                    report(serial + ' | No job in the manifest - swap switch')
+                else:
+                    start = time.time()
+                    for action in job['actions']:
+                        report(serial + ' | ' + action)
+                        if (runAction(action, job['config'], job['variables']) != True):
+                            report(serial + ' | Failed - ' + action + ', see output - swap switch')
+                            break
+                    else:
+                        report(serial + ' | Complete in %ds - swap switch' % (time.time() - start))
+                        last, halted = serial, (job['actions'][-1] == 'power-off')
+            except Exception as reason:
+                report('Failed - ' + str(reason) + ' - swap switch')
+            if not halted:
+                awaitUnplug()
+    except Exception as reason:     #The port itself failed, usually the adapter was pulled
+        report('Stopped - ' + str(reason))
+    return
+
+
+def runConveyor(sessions, jobs):
+    '''Start a conveyor worker per port and print every change of job until Ctrl-C'''
+    stdout = sys.stdout
+    sys.stdout = FleetOutput(stdout)
+    if FLEET_REACTOR and reactorSupported():
+        attachReactor(sessions)
+    progress = Queue.Queue()
+    try:
+        threading.stack_size(FLEET_STACK)
+        for position, current in enumerate(sessions, 1):
+            current.status, current.result, current.output = 'Queued', None, []
+            worker = threading.Thread(target=conveyorWorker, args=(current, jobs, position, progress), name=current.port)
+            worker.daemon = True
+            worker.start()
+        threading.stack_size(0)
+        while True:
+            try:
+                port, result = progress.get(True, FLEET_REFRESH)     #A timeout keeps Ctrl-C responsive
+            except Queue.Empty:
+                continue
+            print(time.strftime('%H:%M:%S ') + port + '\t| ' + result)
+            if result.split(' | ')[-1].startswith('Failed'):
+                print(''.join([current for current in sessions if current.port == port][0].output)[-500:])
+    except KeyboardInterrupt:
+        print('Conveyor stopped')
+    finally:
+        sys.stdout = stdout
+        detachReactor(sessions)
+    return
+    
+    
+    
+################################################################################
+#                                      Timing
+################################################################################
+
+class Span(object):
+    '''
+    Times one phase of a workflow on the current session - wall-clock, time asleep,
+    time blocked on console reads and bytes each way. Spans nest, and the outermost
+    one names the workflow. Each closed span is a line in TIMING_LOG.
+    '''
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.current = session()
+        self.start = time.time()
+        self.counters = self.readCounters()
+        if (self.current.spans == []):    #Replays start from these
+            transcribe('M', self.name)
+        self.current.spans.append(self.name)
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        path = list(self.current.spans)
+        self.current.spans.pop()
+        counters = [now - then for now, then in zip(self.readCounters(), self.counters)]
+        self.current.samples.append((self.name, time.time() - self.start, kind is None, self.start))
+        if (len(path) == 1):
+            storeTimings(self.current)
+        recordSpan({
+            'time': round(self.start, 3), 'port': self.current.port, 'workflow': path[0],
+            'phase': self.name, 'path': '/'.join(path), 'ok': (kind is None),
+            'seconds': round(time.time() - self.start, 3), 'sleep': round(counters[0], 3),
+            'read': round(counters[1], 3), 'bytes_in': counters[2], 'bytes_out': counters[3],
+            }, len(path) == 1)
+        return False
+
+    def readCounters(self):
+        current = self.current
+        return (current.sleepTime, current.readTime, current.bytesIn, current.bytesOut)
+
+
+def timed(name):
+    '''Run every call of the decorated function inside a Span'''
+    def decorate(function):
+        def run(*args, **kwargs):
+            with Span(name):
+                return function(*args, **kwargs)
+        run.__name__, run.__doc__ = function.__name__, function.__doc__
+        return run
+    return decorate
+
+
+def pause(seconds):
+    '''time.sleep() that counts towards the open spans'''
+    time.sleep(seconds)
+    if session() is not None:
+        session().sleepTime += seconds
+    return
+
+
+def recordSpan(record, finished):
+    '''Append a span to TIMING_LOG, refresh TIMING_METRICS once a workflow finishes'''
+    key = (record['workflow'], record['phase'])
+    with TIMING_LOCK:   #Fleet workers share the files
+        totals = TIMING_TOTALS.setdefault(key, [0, 0, 0.0, 0.0, 0.0, 0, 0])
+        for index, value in enumerate([1, int(not record['ok']), record['seconds'], record['sleep'],
+                record['read'], record['bytes_in'], record['bytes_out']]):
+            totals[index] += value
+        try:
+            file = open(TIMING_LOG, 'a')
+            file.write(json.dumps(record, sort_keys=True) + '\n')
+            file.close()
+            if finished:
+                writeMetrics()
+        except (IOError, OSError) as reason:
+            print('Unable to record timing: ' + str(reason))
+    return
+
+
+def writeMetrics():
+    '''Write the phase totals for the Prometheus textfile collector, atomically'''
+    metrics = [
+        ('switchpick_phase_runs_total', 'Times each workflow phase ran', 0),
+        ('switchpick_phase_failures_total', 'Phase runs that ended in an exception', 1),
+        ('switchpick_phase_seconds_total', 'Wall-clock seconds spent in each phase', 2),
+        ('switchpick_phase_sleep_seconds_total', 'Seconds each phase spent in fixed sleeps', 3),
+        ('switchpick_phase_read_seconds_total', 'Seconds each phase spent blocked on console reads', 4),
+        ('switchpick_phase_received_bytes_total', 'Console bytes received in each phase', 5),
+        ('switchpick_phase_sent_bytes_total', 'Console bytes sent in each phase', 6),
+        ]
+    lines = []
+    for metric, description, index in metrics:
+        lines.append('# HELP ' + metric + ' ' + description)
+        lines.append('# TYPE ' + metric + ' counter')
+        for workflow, phase in sorted(TIMING_TOTALS):
+            lines.append(metric + '{workflow="' + workflow + '",phase="' + phase + '"} ' +
+                str(TIMING_TOTALS[(workflow, phase)][index]))
+    file = open(TIMING_METRICS + '.tmp', 'w')
+    file.write('\n'.join(lines) + '\n')
+    file.close()
+    os.rename(TIMING_METRICS + '.tmp', TIMING_METRICS)     #The collector never sees half a file
+    return
+
+
+def learnSwitch(chassis):
+    '''Note the model and JUNOS version from a chassis inventory reply, they key the timing profile'''
+    current = session()
+    if chassis.get('description'):
+        current.model, current.version = chassis['description'], chassis.get('junos-version')
+    return
+
+
+def openTimingProfiles():
+    '''Phase durations per model and JUNOS version live with the provisioning records'''
+    connection = openProvisioningStore()
+    connection.execute('CREATE TABLE IF NOT EXISTS phase_timings (model TEXT, version TEXT, phase TEXT, '
+        'seconds REAL, ok INTEGER, time REAL)')
+    connection.execute('CREATE INDEX IF NOT EXISTS phase_timings_phase ON phase_timings (model, phase, ok, time)')
+    return connection
+
+
+def storeTimings(current):
+    '''Store the spans a session has closed once its model is known, keeps them until then'''
+    if (current.model is None):
+        current.samples = current.samples[-PROFILE_PENDING:]
+        return
+    samples, current.samples = current.samples, []
+    try:
+        connection = openTimingProfiles()
+        try:
+            with connection:
+                connection.executemany('INSERT INTO phase_timings (model, version, phase, seconds, ok, time) '
+                    'VALUES (?, ?, ?, ?, ?, ?)', [(current.model, current.version, phase, seconds, int(ok), start)
+                    for phase, seconds, ok, start in samples])
+        finally:
+            connection.close()
+    except sqlite3.Error as reason:
+        print('Unable to record timing: ' + str(reason))
+    return
+
+
+def phaseTimes(phase):
+    '''
+    Durations of the latest successful runs of a phase on this model, sorted. The same
+    JUNOS version is preferred while it has enough runs. Empty for an unknown model.
+    '''
+    current = session()
+    if (current is None) or (current.model is None):
+        return []
+    try:
+        connection = openTimingProfiles()
+        try:
+            query = 'SELECT seconds FROM phase_timings WHERE model = ? AND phase = ? AND ok = 1'
+            rows = connection.execute(query + ' AND version IS ? ORDER BY time DESC LIMIT ?',
+                (current.model, phase, current.version, PROFILE_HISTORY)).fetchall()
+            if (len(rows) < PROFILE_MIN_RUNS):
+                rows = connection.execute(query + ' ORDER BY time DESC LIMIT ?',
+                    (current.model, phase, PROFILE_HISTORY)).fetchall()
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return []
+    return sorted([row[0] for row in rows])
+
+
+def percentile(times, share):
+    '''Nearest-rank percentile of sorted durations'''
+    return times[min(len(times) - 1, max(0, int(len(times) * share / 100.0 + 0.5) - 1))]
+
+
+def budget(phase, default):
+    '''Seconds to allow a phase on this model before giving up, default without enough history'''
+    times = phaseTimes(phase)
+    if (len(times) < PROFILE_MIN_RUNS):
+        return default
+    return max(READ_TIMEOUT, percentile(times, PROFILE_PERCENTILE) * PROFILE_MARGIN)
+
+
+def expected(phase, default):
+    '''How long a phase usually takes on this model, for messages, default without enough history'''
+    times = phaseTimes(phase)
+    if (len(times) < PROFILE_MIN_RUNS):
+        return default
+    typical = percentile(times, 50)
+    return ('about %d seconds' % typical) if (typical < 90) else ('about %d minutes' % int(typical / 60 + 0.5))
     
     
     
@@ -191,6 +971,8 @@ def credentials():
     global USERNAME, PASSWORD
     USERNAME = raw_input('Username: ').rstrip('\n')
     PASSWORD = raw_input('Password: ').rstrip('\n')
+    session().username = USERNAME
+    session().password = PASSWORD
     print('-'*40)
     
     return
@@ -203,138 +985,442 @@ def loadConfig():
     Load the config, ensure all commits are successful
     Clone configs to rescue files    
     '''
+    global FAST_TRANSFER, DISABLE_AUTO_UPDATE, COMMIT_CHECK, SINGLE_COMMIT, FAST_PATH, CONFIG_TRANSFER
     print('-'*40)
     print('Switch Config | Load a config/txt and commit changes')
     print(' .'*20)
     print('\t1) Priming Config')
     print('\t2) Custom Config')
+    print('\t3) Fast Transfer: ' + (str(FAST_BAUDRATE) + ' baud' if FAST_TRANSFER else 'Off'))
+    print('\t4) Auto-Update: ' + ('Disabled' if DISABLE_AUTO_UPDATE else 'Factory default'))
+    print('\t5) Commits: ' + ('Single' if SINGLE_COMMIT else 'Password first'))
+    print('\t6) Commit Check: ' + ('On' if COMMIT_CHECK else 'Off'))
+    print('\t7) Repeat Loads: ' + {'off': 'Always load', 'skip': 'Skip if applied', 'delta': 'Skip or load changes'}[FAST_PATH])
+    print('\t8) Transfer: ' + {'paste': 'Paste to terminal', 'upload': 'Compressed upload'}[CONFIG_TRANSFER])
     print('-'*40)
     
-    choice = option(0, 2)
-    if choice == 1:
-        configFile = GENERAL_CONFIG
-    elif choice == 2:
-        configFile = fileName()
-        if (configFile == ''):
-            raise Exception('No file specified')
+    choice = option(0, 8)
+    if choice == 0:
+        return
+    elif choice == 3:
+        FAST_TRANSFER = not FAST_TRANSFER
+        return loadConfig()
+    elif choice == 4:
+        DISABLE_AUTO_UPDATE = not DISABLE_AUTO_UPDATE
+        return loadConfig()
+    elif choice == 5:
+        SINGLE_COMMIT = not SINGLE_COMMIT
+        return loadConfig()
+    elif choice == 6:
+        COMMIT_CHECK = not COMMIT_CHECK
+        return loadConfig()
+    elif choice == 7:
+        FAST_PATH = {'off': 'skip', 'skip': 'delta', 'delta': 'off'}[FAST_PATH]
+        return loadConfig()
+    elif choice == 8:
+        CONFIG_TRANSFER = {'paste': 'upload', 'upload': 'paste'}[CONFIG_TRANSFER]
+        return loadConfig()
+    configFile = chooseConfigFile(choice)
             
     print('-'*50)
     print('Loading Config:\n' + configFile)
     print('-'*50)
     
     try:
+        if not checkConfig(configFile):
+            raise Exception('Config file failed its checks, nothing was sent to the switch')
+        if applyConfig(configFile):
+            print('Config complete!')
     
-        if (ENCRYPTED_PASSWORD == ''):
+    except Exception as reason:
+        returnException(reason)
+    return    
+
+
+def chooseConfigFile(choice):
+    '''Map a config menu choice to a file, prompting for custom configs'''
+    if choice == 1:
+        return GENERAL_CONFIG
+    configFile = fileName()
+    if (configFile == ''):
+        raise Exception('No file specified')
+    return configFile
+
+
+@timed('config_load')
+def applyConfig(configFile, variables=None):
+    '''
+    Console in, commit encrypted credentials, then load and commit a config file
+    Templates are rendered for the switch's serial number, variables (from a manifest) on top
+    A switch that already runs the config is left alone (see FAST_PATH)
+    Returns False if either commit fails, exceptions are left to the caller
+    '''
+    if (session().encryptedPassword == ''):
             raise Exception('Fatal Error - no encryption password or hash loaded in credentials.txt')
-        '''
-        There are two kinds of config files that go through different processes:
-            .config / "Stanza" | Must load with override terminal, no formatting
-            .txt / "Excel configs" | Must load with set terminal, program will format before writing
-        '''
-        terminalType = 'set' if (configFile[-4:] == '.txt') else 'override'
-        
-        #Navigate to config, loop until the session is stable
-        checkActivity()
-        goToLogin()
-        login()
-        cli()
-        config()
-
-        #Commit a password - first step for security purposes
-        command('#', 'load factory-default', '\nLoading Factory Settings...')
-        command('#', ('set system root-authentication encrypted-password ' + ENCRYPTED_PASSWORD), '\tSetting Encrypted Root Password...')
-        command('#', 'commit comment "loading factory-default"', 'Committing Initial Password...', False)
-        if goodCommit() != True:
-            return
+    checkActivity()
+    if configFile.endswith('.tmpl'):
+        serial = chassisSerial()
+        if (serial is None):
+            raise Exception('Unable to read the serial number to fill in ' + configFile)
+        variables = templateVariables(configFile, serial, variables)
+    terminalType, configData = readConfig(configFile, variables)
+    key = configKey(terminalType, configData)
+    
+    if (FAST_PATH != 'off'):
+        goToState('operational')
+        checksum = activeChecksum()
+        if checksum and (checksum == lookupConfigChecksum(key)):
+            print('Switch already runs this config, nothing to load.')
+            gatherProvisioningInfo(configFile)
+            return True
+        if checksum and (FAST_PATH == 'delta') and (terminalType == 'set'):
+            delta = deltaConfig(configData, checksum)
+            applied = applyDelta(configFile, key, configData, delta, checksum) if delta else None
+            if (applied is not None):
+                return applied
+    
+    staged = stageConfig(configData) if (CONFIG_TRANSFER == 'upload') else None
+
+    #Navigate to config, loop until the session is stable
+    goToState('configuration')
+
+    #Commit a password - first step for security purposes
+    command('#', 'load factory-default', '\nLoading Factory Settings...')
+    if DISABLE_AUTO_UPDATE:     #Later config sessions won't be closed on us
+        command('#', 'delete chassis auto-image-upgrade', '\tDisabling Auto-Update...')
+    command('#', ('set system root-authentication encrypted-password ' + session().encryptedPassword), '\tSetting Encrypted Root Password...')
+    #The upshift commits whatever is in the candidate, so fast transfers keep the password commit.
+    #An override load replaces root-authentication, only set loads keep the password to commit
+    if SINGLE_COMMIT and not FAST_TRANSFER and (terminalType == 'set'):
+        print('Single commit - the password is committed with the loaded configs.')
+    else:
+        if SINGLE_COMMIT and (terminalType != 'set'):
+            print('Single commit only applies to set configs - an override load would drop the password.')
+        with Span('factory_default_commit'):
+            if commitConfig('comment "loading factory-default"', 'Committing Initial Password...', False) != True:
+                return False
         print('Encrypted login credentials commited.')
-        
-        #Load a terminal and apply bulk configurations
+    fast = FAST_TRANSFER and (staged is None) and upshift()    #An uploaded config is already on the switch
+    
+    #Load a terminal or the uploaded file and apply bulk configurations
+    if staged:
+        loadFile(terminalType, staged)
+    else:
+        loadTerminal(terminalType, configData)
+    if fast:    #Override loads drop the speed, keep it so the commit result stays readable
+        command('#', 'set system ports console speed ' + str(FAST_BAUDRATE), '\tHolding console speed for the commit...')
+    #Commit and copy config
+    with Span('final_commit'):
+        committed = commitConfig('and-quit', 'Committing loaded configs...', COMMIT_CHECK)
+    if committed:
+        session().state = 'operational'
+    if fast:
+        downshift(committed)
+    if committed != True:
+        return False
+    print('Configuration file loaded without errors.')
+    checksum = rescueSave(FAST_PATH != 'off')
+    
+    if (FAST_PATH != 'off'):
+        storeConfigChecksum(key, checksum, terminalType, configData)
+    gatherProvisioningInfo(configFile)
+    return True
+
+
+@timed('delta_load')
+def applyDelta(configFile, key, configData, delta, checksum):
+    '''
+    Bring a switch running an earlier version of a set config up to date by loading
+    only the changed lines - removed statements are deleted before new ones are set
+    Returns None if the switch didn't change, the full config is loaded instead
+    '''
+    print('Switch runs an earlier version of this config, loading ' + str(len(delta)) + ' changed lines.')
+    goToState('configuration')
+    loadTerminal('set', '\n'.join(delta) + '\n')
+    if commitConfig('and-quit', 'Committing changed lines...', COMMIT_CHECK) != True:
+        return False
+    session().state = 'operational'
+    updated = activeChecksum()
+    if (updated == checksum):
+        print('The changes did not reach the switch, loading the full config.')
+        return None
+    print('Configuration changes loaded without errors.')
+    rescueSave()
+    
+    storeConfigChecksum(key, updated, 'set', configData)
+    gatherProvisioningInfo(configFile)
+    return True
+
+
+def readConfig(configFile, variables=None):
+    '''
+    There are two kinds of config files that go through different processes:
+        .config / "Stanza" | Must load with override terminal, no formatting
+        .txt / "Excel configs" | Must load with set terminal, program will format before writing
+    Templates of either (.config.tmpl / .txt.tmpl) are rendered with variables
+    Returns the terminal type and the data to write to it
+    '''
+    if configFile.endswith('.tmpl'):
+        return renderTemplate(configFile, variables or {})
+    terminalType = 'set' if (configFile[-4:] == '.txt') else 'override'
+    r = open(configFile, 'r')
+    configData = r.read()
+    r.close()
+    if (terminalType == 'set'):
+        configData = configData.format(r'\r\n\\')   #Format with raw newlines
+    return terminalType, configData
+
+
+@timed('terminal_paste')
+def loadTerminal(terminalType, configData):
+    '''
+    Open a load terminal from config mode, type the config data into it at the pace
+    the switch echoes it back, close it and wait for JUNOS to finish parsing
+    '''
+    for pipeline in (True, False):
         command('#', ('load '+terminalType+' terminal'),
             ('\nOpening '+terminalType+' terminal...'))
-        r = open(configFile, 'r')
-        configData = r.read()
-        if (terminalType == 'set'):
-            configData = configData.format(r'\r\n\\')   #Format with raw newlines
+        #Typing starts only after the whole banner, or its tail would read as a garbled echo
+        if (expect(['end input]'], READ_TIMEOUT) < 0) or (expect(['\n'], ECHO_TIMEOUT) < 0):
+            raise Exception('No load terminal opened')
+        print('\tLoading configs...')
         try:
-            time.sleep(5)   #Configs can be 1K lines, interpreter needs a moment to process
-            print('\tLoading configs (2 minutes)...')
-            CONSOLE.write(configData)   #Takes a bit
-            time.sleep(5)
-            print('\tConfigs loaded to terminal.')
-        except:
-            print('Error: Unable to write config data to console.')
-        r.close()
-        #Write a raw newline & the hex code for CTRL-D
-        command('', '\r\n\x04', 'Closing terminal', True, False)
-        time.sleep(5)   #Time MUST pass for this to process
-        #Commit and copy config
-        command('#', 'commit and-quit', 'Committing loaded configs...', False)
-        if goodCommit() != True:
-            return
-        print('Configuration file loaded without errors.')
-        command('}', 'request system configuration rescue save', '\nCloning configs to rescue settings...')
-        
-        time.sleep(5)   #Let the system grab an available IP
-        gatherProvisioningInfo(configFile)
-        
-        print('Config complete!')
-    
+            resent = pasteConfig(configData, pipeline)
+            break
+        except PasteGarbled as reason:
+            print('\t' + str(reason) + ', typing the configs again line by line...')
+            writeSerial('\x03')    #Cancel the load, nothing typed into it is kept
+            drainSerial()
+    print('\tConfigs loaded to terminal' + ((', %d garbled lines typed again' % resent) if resent else '') + '.')
+    #The hex code for CTRL-D, the last line already ended with a newline
+    writeSerial('\x04')
+    print('Closing terminal')
+    if (expect(['load complete', 'error:'], budget('terminal_paste', LOAD_TIMEOUT)) != 0):
+        print('\tJUNOS did not report a clean load: ' + session().before.strip()[-200:])
+    return
+
+
+@timed('config_upload')
+def stageConfig(configData):
+    '''
+    Upload the config from the shell to a file on the switch, gzipped, so far fewer
+    bytes cross the console than a paste would type. Returns the path to load, or
+    None if the upload didn't get through and the config should be pasted instead.
+    '''
+    configData = configData.replace('\r\n', '\n')
+    if not configData.endswith('\n'):
+        configData += '\n'
+    goToState('shell')
+    print('\nUploading config...')
+    try:
+        uploadFile(configData, STAGE_FILE)
     except Exception as reason:
-        returnException(reason)
-    return    
+        print('\tUpload failed (' + str(reason) + '), the config will be pasted instead.')
+        return None
+    print('\tConfig uploaded to ' + STAGE_FILE + '.')
+    return STAGE_FILE
+
+
+@timed('file_load')
+def loadFile(terminalType, path):
+    '''
+    Load a config file already on the switch from config mode, wait for JUNOS to parse it.
+    The file is deleted either way, it holds the whole config including the password hash.
+    '''
+    command('#', ('load ' + terminalType + ' ' + path), ('\nLoading uploaded configs...'))
+    loaded = expect(['load complete', 'error:'], budget('file_load', LOAD_TIMEOUT))
+    output = session().before.strip()[-200:]
+    command('#', 'run file delete ' + path, '\tRemoving uploaded configs...', timeout=READ_TIMEOUT)
+    if (loaded != 0):
+        raise Exception('JUNOS could not load ' + path + ': ' + output)
+    return
+
+
+class PasteGarbled(Exception):
+    '''A line typed in a window of whole lines echoed garbled, it can no longer be erased'''
+    pass
+
+
+def pasteConfig(configData, pipeline=True):
+    '''
+    Type config lines into an open load terminal. With pipeline, whole lines go out
+    together in windows sized to the console's receive buffer, and their echoes are checked
+    line by line as they come back. Clean lines grow the window. A line is committed at its
+    newline, so a garbled one in a window raises PasteGarbled - the caller abandons the
+    terminal with Ctrl-C and types it all again without pipeline. Then each line is checked
+    against its echo before the newline commits it, and the newline against its own. A line
+    that echoes garbled is erased with Ctrl-U and typed again, and halves the window.
+    Lines longer than the window always go that way, a window at a time.
+    Returns the number of lines typed again, raises if one can't get through.
+    '''
+    window, resent = PASTE_WINDOW, 0
+    lines = [line.rstrip('\r') for line in configData.split('\n')]
+    if (lines[-1] == ''):
+        lines.pop()
+    index = 0
+    while (index < len(lines)):
+        batch, size = [], 0
+        while pipeline and (index + len(batch) < len(lines)) and (size + len(lines[index + len(batch)]) < window):
+            size += len(lines[index + len(batch)]) + 1
+            batch.append(lines[index + len(batch)])
+        if batch:
+            writeSerial(''.join([line + '\n' for line in batch]))
+            clean = echoLines(batch)
+            if (clean < len(batch)):
+                raise PasteGarbled('Config line garbled in a window of ' + str(len(batch)) + ': ' + batch[clean][:60])
+            window = min(PASTE_MAX, window + PASTE_STEP * len(batch))
+            index += len(batch)
+            continue
+        line = lines[index]
+        for attempt in range(PASTE_RETRIES + 1):
+            if typeLine(line, window):
+                window = min(PASTE_MAX, window + PASTE_STEP)
+                break
+            writeSerial('\x15')    #Ctrl-U erases the line typed so far
+            drainSerial()
+            window = max(PASTE_MIN, window // 2)
+            resent += 1
+        else:
+            raise Exception('Config line garbled ' + str(PASTE_RETRIES + 1) + ' times: ' + line[:60])
+        #A lost newline would join two lines, a doubled one only adds an empty line
+        for attempt in range(PASTE_RETRIES + 1):
+            writeSerial('\n')
+            if (expect(['\n'], ECHO_TIMEOUT) >= 0):
+                break
+        else:
+            raise Exception('No echo of the newline after: ' + line[:60])
+        index += 1
+    return resent
+
+
+def echoLines(lines):
+    '''Read back the echo of lines typed in one go, returns how many came back intact before the first that didn't'''
+    current = session()
+    echo, deadline = '', time.time() + ECHO_TIMEOUT
+    for count in range(len(lines)):
+        while ('\n' not in echo):
+            remaining = deadline - time.time()
+            if (remaining <= 0):
+                return count
+            if pollSerial(min(remaining, PULL_INTERVAL)):
+                deadline = time.time() + ECHO_TIMEOUT   #Still echoing, just slowly
+            received, current.buffer = current.buffer, ''
+            echo += received
+        line, echo = echo.split('\n', 1)
+        if (line.rstrip('\r') != lines[count]):
+            return count
+    current.buffer = echo + current.buffer
+    return len(lines)
+
+
+def typeLine(line, window):
+    '''Type a line without its newline, a window at a time, True if the echo matches'''
+    current = session()
+    echo = ''
+    for start in range(0, len(line), window):
+        chunk = line[start:start + window]
+        writeSerial(chunk)
+        end = start + len(chunk)
+        deadline = time.time() + ECHO_TIMEOUT
+        while (len(echo) < end):
+            remaining = deadline - time.time()
+            if (remaining <= 0) or (echo != line[:len(echo)]):
+                return False
+            if pollSerial(min(remaining, PULL_INTERVAL)):
+                deadline = time.time() + ECHO_TIMEOUT   #Still echoing, just slowly
+            received, current.buffer = current.buffer, ''
+            echo += received
+    return echo == line
+
+
+def drainSerial():
+    '''Wait for the console to go quiet, then drop whatever it sent'''
+    while pollSerial(ECHO_TIMEOUT / 4.0):
+        pass
+    clearBuffer()
+    return
     
     
 def logs():
-    '''Generate support information, copy to a USB drive connected to a switch'''
+    '''Generate support information, copy it to a USB drive or stream it back over the console'''
     print('-'*40)
-    print('Log Generator | Copies log files to USB drive')
+    print('Log Generator | Collect RSI and log files')
+    print(' .'*20)
+    print('\t1) Copy to USB drive')
+    print('\t2) Stream to this computer')
     print('-'*40)
     
-    try:
+    choice = option(0, 2)
+    if (choice == 0):
+        return
     
-        checkActivity()
-        goToLogin()
-        login()
-        cli()
-        command('}', 'request support information | save /var/tmp/RSI.txt', 'Generating RSI files (2 minutes)')
-        command('}', 'file archive source /var/log destination /var/tmp/LOGS', 'Generating LOG file (30 seconds)', False)
-        command('}', 'start shell', 'Moving to shell mode', False)
-        
-        #Find a drive, mount it, and ensure it is functional
-        print('Searching for Drive...')
-        '''
-        Loops until we can verify the drive was NOT rejected
-        There is NO success message and thus we can't guarentee a mount is formatted well
-        '''
-        while True:
-            time.sleep(1)
-            response = readSerial()
-            if ('%' in response):
-                CONSOLE.write('mount_msdosfs /dev/da1s1 /mnt' + '\n')
-                time.sleep(5)       #This command takes a few seconds to process
-                response = readSerial()
-                if ('not permitted' in response):
-                    goToLogin()
-                    raise Exception('Fatal Error - insufficient permission, unable to mount drives.')
-                elif ('no such' not in response) and ('%' in response):
-                    print('Drive mounted to /mnt, no errors received from JUNOS')
-                    break
-                else:
-                    print('...No drive found. Retrying in 15 seconds...')
-                    time.sleep(10)
-                CONSOLE.write('\n') #Priming for a new loop
-        command('%', 'cp /var/tmp/RSI.txt /mnt', 'Copying RSI files')
-        command('%', 'cp /var/tmp/LOGS.tar /mnt', 'Copying LOG files', False)
-        command('%', 'umount /mnt', '\nLogs copied! Unmounting drive /mnt', False)    #umount != unmount
-        
-        print('Logging out for security.')
-        goToLogin()
+    try:
+        collectLogs(choice == 2)
         print('Process complete, console at the login screen.')
     
     except Exception as reason:
         returnException(reason)
     return
 
+
+@timed('log_grab')
+def collectLogs(stream=False):
+    '''
+    Generate RSI and log archives side by side on the switch, then copy both to the USB
+    drive - or compress and stream them into LOG_DIRECTORY/<serial> - and log out
+    '''
+    checkActivity()
+    serial = chassisSerial() if stream else None
+    goToState('shell')
+    with Span('log_archives'):
+        print('Generating RSI and LOG files together (' + expected('log_archives', '2 minutes') + ')...')
+        archive = 'file archive ' + ('compress ' if stream else '') + 'source /var/log destination /var/tmp/LOGS'
+        timeout = budget('log_archives', LOG_TIMEOUT)
+        if shellRun('cli -c "request support information | save /var/tmp/RSI.txt" & cli -c "' + archive + '" & wait',
+                timeout) is None:
+            raise Exception('RSI and LOG files not generated within ' + str(int(timeout)) + ' seconds')
+    
+    if stream:
+        directory = os.path.join(LOG_DIRECTORY, serial or 'unknown')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with Span('log_stream'):
+            shellRun('gzip -f /var/tmp/RSI.txt')
+            for path in ('/var/tmp/RSI.txt.gz', '/var/tmp/LOGS.tgz'):
+                print('Streaming ' + path + '...')
+                print('\tMD5 ' + fetchFile(path, directory) + ' verified')
+        print('Logs saved to ' + directory)
+        print('Logging out for security.')
+        goToLogin()
+        return True
+    
+    #Find the drive, the switch's own flash is also a da disk
+    print('Searching for Drive...')
+    drive = findDrive()
+    if (drive is None):
+        goToLogin()
+        raise Exception('No USB drive found in the switch within ' + str(DRIVE_TIMEOUT) + ' seconds')
+    response = shellRun('mount_msdosfs ' + drive + ' /mnt')
+    if (response is None):
+        raise Exception('No answer from the switch while mounting ' + drive)
+    elif ('not permitted' in response):
+        goToLogin()
+        raise Exception('Fatal Error - insufficient permission, unable to mount drives.')
+    elif (response != ''):
+        goToLogin()
+        raise Exception('Unable to mount ' + drive + ': ' + response)
+    print('Drive ' + drive + ' mounted to /mnt')
+    print('Copying RSI and LOG files')
+    response = shellRun('cp /var/tmp/RSI.txt /var/tmp/LOGS.tar /mnt; umount /mnt', LOG_TIMEOUT)   #umount != unmount
+    if (response != ''):
+        goToLogin()
+        raise Exception('Copying logs to ' + drive + ' failed: ' + str(response))
+    print('\nLogs copied! Drive unmounted from /mnt')
+    
+    print('Logging out for security.')
+    goToLogin()
+    return True
+
     
 def wipe():
     '''Clear a switch without zeroize, thus retaining long-term support/operational data'''
@@ -353,35 +1439,145 @@ def wipe():
     print('-'*40)
     
     try:
+        if wipeSettings(choice == 2):
+            print('Wipe complete!')
+        else:
+            print('Wipe incomplete - files listed above are still on the switch')
         
-        checkActivity()
-        
-        #Start a shell session
-        if (choice == 1): #From login screen
-            goToLogin()
-            login()
-        else:             #Using loader override
-            print('Note: This process takes a LONG time (~10 minutes)')
+    except Exception as reason:
+        returnException(reason)
+    return
+
+
+@timed('wipe')
+def wipeSettings(useLoader=False):
+    '''
+    Remove configs and config databases from a shell session, in one round trip that
+    ends with a listing of what is left. False if any target survived.
+    '''
+    checkActivity()
+    
+    #Start a shell session
+    if (useLoader == False): #From wherever the console is
+        goToState('shell')
+    else:             #Using loader override
+        print('Note: This process takes a LONG time (' + expected('single_user_boot', '~10 minutes') + ')')
+        with Span('single_user_boot'):
             loader()
-            CONSOLE.write('boot -s\n')
+            writeSerial('boot -s\n')
             print('Booting in single user mode (1 minute)...')
             command('root password recovery', 'recovery', 'Starting password recovery, (4 minutes)...', False)
             command('}', 'start shell', 'Starting Shell...', False)
-            
-        command('%', 'cd /config', 'Directory: /config')
-        command('%', 'rm juniper.conf.gz', '\tRemoving: juniper.conf.gz')
-        command('%', 'rm juniper.conf.*.gz', '\tRemoving: juniper.conf.*.gz')
-        command('%', 'rm rescue.conf.gz', '\tRemoving: rescue.conf.gz')
-        command('%', 'cd /var/run/db', 'Directory: /var/run/db', False)
-        command('%', 'rm juniper.db', '\tRemoving: juniper.db')
-        command('%', 'rm juniper.data', '\tRemoving: juniper.data')
-        command('%', 'rm juniper.save', '\tRemoving: juniper.save')
-        
-        print('Wipe complete!')
-        
+        session().state = 'shell'
+    
+    #One rm per target, csh skips a whole command when one of its patterns matches nothing
+    removals = ['rm -f ' + directory + '/' + name for directory, names in WIPE_TARGETS for name in names]
+    directories = ' '.join([directory for directory, names in WIPE_TARGETS])
+    output = shellRun('; '.join(removals) + '; echo "' + SHELL_MARKER + '""-LIST"; ls -1 ' + directories)
+    if (output is None) or (SHELL_MARKER + '-LIST' not in output):
+        raise Exception('No answer from the switch while removing configs')
+    errors, listing = output.split(SHELL_MARKER + '-LIST', 1)
+    if errors.strip():
+        print(errors.strip())
+    
+    #ls names each directory before its files when given more than one, and lists them
+    #in columns on a tty unless told -1, so lines are split on whitespace either way
+    remaining, directory = {}, None
+    for line in listing.split('\n'):
+        line = line.strip()
+        if line.endswith(':'):
+            directory = line[:-1]
+        elif line and (directory is not None):
+            remaining.setdefault(directory, []).extend(line.split())
+    wiped = True
+    for directory, names in WIPE_TARGETS:
+        print('Directory: ' + directory)
+        for name in names:
+            left = fnmatch.filter(remaining.get(directory, []), name)
+            if left:
+                print('\tStill present: ' + ', '.join(left))
+                wiped = False
+            else:
+                print('\tRemoved: ' + name)
+    return wiped
+
+
+def fleet():
+    '''Run one job on every connected switch at once, one worker per serial port'''
+    print('-'*40)
+    print('Fleet Mode | Provision every connected switch')
+    print(' .'*20)
+    print('\t1) Priming Config')
+    print('\t2) Custom Config')
+    print('\t3) Wipe w/ login')
+    print('-'*40)
+    
+    choice = option(0, 3)
+    if (choice == 0):
+        return
+    elif (choice == 3):
+        job = wipeSettings
+    else:
+        configFile = chooseConfigFile(choice)
+        if not checkConfig(configFile):
+            returnException('Config file failed its checks, nothing was sent to the switches')
+            return
+        job = lambda: applyConfig(configFile)
+    
+    sessions = openFleet()
+    print('Fleet ports: ' + ', '.join([current.port for current in sessions]))
+    try:
+        runFleet(sessions, job)
     except Exception as reason:
         returnException(reason)
+    finally:
+        for current in sessions[1:]:    #The menu keeps the first port
+            current.console.close()
     return
+
+
+def conveyor(manifest, port=None):
+    '''Headless batch mode - every switch cabled in gets its manifest job, technicians only swap cables'''
+    print('-'*40)
+    print('Conveyor Mode | ' + manifest)
+    print(' .'*20)
+    try:
+        jobs = loadManifest(manifest)
+    except Exception as reason:
+        print('Unable to load the manifest: ' + str(reason))
+        return
+    sessions = openConveyor(port)
+    if (sessions == []):
+        print('No console ports available')
+        return
+    for position, current in enumerate(sessions, 1):
+        print('\t%d) %s' % (position, current.port))
+    print('Swap switches as each job completes, Ctrl-C to stop')
+    print('-'*40)
+    try:
+        runConveyor(sessions, jobs)
+    finally:
+        for current in sessions:
+            current.console.close()
+    return
+
+
+def runAction(action, configFile, variables=None):
+    '''Run one manifest action on the current switch, the way the menus would minus the prompts'''
+    if (action == 'wipe'):
+        return wipeSettings(False)
+    elif (action == 'prime'):
+        return applyConfig(configFile or GENERAL_CONFIG, variables)
+    elif (action == 'custom'):
+        return applyConfig(configFile, variables)
+    elif (action == 'gather'):
+        goToState('operational')
+        gatherProvisioningInfo(configFile)
+        return True
+    elif (action == 'reboot'):
+        return restartSwitch()
+    elif (action == 'power-off'):
+        return haltSwitch()
         
 
 def powerOptions():
@@ -408,6 +1604,38 @@ def powerOptions():
     except Exception as reason:
         returnException(reason)
     return
+
+
+def provisioning():
+    '''Look up, export or clear the records of provisioned switches'''
+    print('-'*40)
+    print('Provisioning | Deployment records')
+    print(' .'*20)
+    print('\t1) Look up a switch (serial, MAC or config)')
+    print('\t2) Export to CSV')
+    print('\t3) Clear records')
+    print('-'*40)
+    choice = option(0, 3)
+    print('-'*40)
+    try:
+        if (choice == 1):
+            value = raw_input('Serial / MAC / Config >    ').strip()
+            records = findProvisioningRecords(value)
+            for record in records:
+                print('\t'.join([str(field) for field in record]))
+            print(str(len(records)) + ' record(s) found for ' + value)
+        elif (choice == 2):
+            count = exportProvisioningLog(PROVISIONING_LOG)
+            print('Exported ' + str(count) + ' records to ' + PROVISIONING_LOG)
+        elif (choice == 3):
+            print('\t1) Return to Menu')
+            print('\t2) Clear ALL records')
+            if (option(0, 2) == 2):
+                clearProvisioningLog()
+    
+    except Exception as reason:
+        returnException(reason)
+    return
     
     
     
@@ -419,14 +1647,15 @@ def loader():
     '''Go to the "loader override" when you turn on a switch'''
     print('Attempting to enter loader...')
     while True:
-        time.sleep(1)
-        CONSOLE.write(' ')
-        prompt = readSerial()
-        if ('loader>' in prompt):
+        writeSerial(' ')    #Space bar interrupts the autoboot countdown
+        prompt = expect(['loader>', 'login:'], 0.5)
+        if (prompt == 0):
             print('Loader initialized.')
+            session().state = 'loader'
             break
-        elif ('login:' in prompt):
+        elif (prompt == 1):
             print('Reached login screen instead.')
+            session().state = 'login'
             break
     return
 
@@ -435,12 +1664,10 @@ def checkActivity():
     '''Ensure a switch is active / console I/O is currently working'''
     print('Verifying console device is active...')
     for i in range(10):        
-        response = readSerial()
-        if (response != ''):
+        if (session().buffer != '') or pollSerial(0.5):
             return
         else:
-            CONSOLE.write('\n')
-            time.sleep(0.5)
+            writeSerial('\n')
             
     raise Exception('No activity or response from console device')
     return
@@ -449,140 +1676,443 @@ def checkActivity():
 def goToLogin():
     '''Exit out of all prompts until the login screen is reached'''
     print('Reaching login(can take 2-3 minutes)')
-    CONSOLE.write('\n')
-    while True:
-        time.sleep(1)
-        prompt = readSerial()
-        if ('login:' in prompt):
-            break
-        elif ('[yes,no]' in prompt):    #Interrupt any commits
-            CONSOLE.write('yes' + '\n')
-        elif ('#' in prompt):
-            CONSOLE.write(('exit' + '\n')*4)
-        elif ('}' in prompt):
-            CONSOLE.write(('exit' + '\n')*2)
-        elif ('%' in prompt):
-            CONSOLE.write('exit' + '\n')
-        else:
-            CONSOLE.write('\n')
-            time.sleep(14)
+    goToState('login')
+    return
+
+
+def promptState(pull=True):
+    '''
+    Identify the prompt the console is sitting at and track it in the session.
+    With pull, stale output is dropped and a newline asks for a fresh prompt,
+    otherwise the next prompt already on its way is used. None if nothing answers.
+    '''
+    if pull:
+        clearBuffer()
+        writeSerial('\n')
+    found = expect([prompt for prompt, state in PROMPT_STATES], LOGIN_WAIT)
+    session().state = PROMPT_STATES[found][1] if (found >= 0) else None
+    return session().state
+
+
+@timed('navigation')
+def goToState(target):
+    '''
+    Move the console to login, shell, operational or configuration by the shortest
+    path from where it actually is. Each step is checked against the prompt that
+    answers it, so shells started from the CLI (and CLIs from shells) unwind in order.
+    '''
+    if target not in ('login', 'shell', 'operational', 'configuration'):
+        raise Exception('Unable to reach the ' + target + ' prompt from the console')
+    state = promptState()
+    while (state != target):
+        if (state is None):     #Booting or busy, keep nudging
             print('...')
+            state = promptState()
+            continue
+        elif (state in ('password', 'confirm')):    #The pulled newline abandons a login, or takes the default answer
+            state = promptState()
+            continue
+        elif (state == 'login'):
+            login()
+            state = promptState()
+            continue
+        elif (state == 'operational') and (target == 'configuration'):
+            config()
+            state = session().state
+            continue
+        elif (state == 'loader'):
+            step = 'boot'
+        elif (state == 'configuration'):
+            step = 'exit configuration-mode'
+        elif (state == 'shell'):
+            step = 'exit' if (target == 'login') else 'cli'
+        else:
+            step = 'exit' if (target == 'login') else 'start shell'
+        writeSerial(step + '\n')
+        expect([step], LOGIN_WAIT)  #Prompts still on their way from before the step are stale
+        state = promptState(False)
     return
     
     
+@timed('login')
 def login():
     '''Login to a switch, raise an exception if necessary'''
     print('Attempting login...')
-    command('login:', USERNAME, 'Logging in...')
+    command('login:', session().username, 'Logging in...')
+    passwordSent = False
     while True:
-        time.sleep(0.5)
-        prompt = readSerial()
+        prompt = expect(['word:', 'login', 'incorrect', 'JUNOS', '%'], LOGIN_WAIT)
         #Password and Local Password are always the same, this statement covers both:
-        if ('word:' in prompt):
-            CONSOLE.write(PASSWORD + '\n')
-        elif ('login' in prompt):       #Username was refused and re-prompted
+        if (prompt == 0):
+            writeSerial(session().password + '\n', True)
+            passwordSent = True
+        elif (prompt == 1) and passwordSent:    #Username was refused and re-prompted
             raise Exception('Fatal error - wrong username')
-        elif ('incorrect' in prompt):   #Incorrect password
+        elif (prompt == 1):     #Answer to a pulled newline that was still on its way
+            continue
+        elif (prompt == 2):     #Incorrect password
             raise Exception('Fatal error - wrong password')
-        elif ('JUNOS' in prompt) or ('%' in prompt):
-            print('Logged in as ' + USERNAME + '; ' + ('*' * len(PASSWORD)) + '\n')
+        elif (prompt in (3, 4)):
+            print('Logged in as ' + session().username + '; ' + ('*' * len(session().password)) + '\n')
             break
-        elif (prompt == ''):
-            CONSOLE.write('\n')
+        else:
+            writeSerial('\n')
     return
     
     
 def cli():
     '''Issue commands to enter CLI mode'''
     command('%', 'cli', 'Entering CLI...')
+    session().state = 'operational'
     return
     
     
+@timed('config_mode')
 def config():
     '''
     Enter configuration mode in preparation to commit changes
     Verify mode can be sustained - JUNOS cancels sessions with "Auto-Update"
-    40% of the time within the first 5 seconds. Hence why we sleep for 15 seconds.
+    40% of the time within the first 5 seconds, but only while chassis
+    auto-image-upgrade is configured. Without it the session is steady right away.
     '''
     while True:
-        command('}', 'configure', 'Entering config mode, verifying stable session... (30 secs)')
-        time.sleep(30)  #Wait and see if the system or autoupdate terminated config mode.
-        if ('unexpectedly closed connection' not in readSerial()):
+        autoUpdate = autoUpdateEnabled()
+        command('}', 'configure', 'Entering config mode, verifying stable session...')
+        if configSettled(autoUpdate):
             print('Config mode enabled, steady.')
+            session().state = 'configuration'
             break
         else:
             print('Config mode was closed by JUNOS, attempting to reopen')
-            cli()
+            goToState('operational')
     return
 
-    
-def goodCommit():
-    '''Loops until we have absolute verification that commits were successful'''
+
+def autoUpdateEnabled():
+    '''Ask the active config whether Auto-Update is on, an unclear answer counts as yes'''
+    command('}', 'show configuration chassis | match auto-image-upgrade | count', '')
+    return (expect([' 0 lines', ' lines'], READ_TIMEOUT) != 0)
+
+
+def configSettled(autoUpdate):
+    '''
+    Watch a new config session until Auto-Update can no longer close it, sending an
+    empty line every CONFIG_PROBE seconds - a closed session answers from the shell.
+    Returns False as soon as the session is closed.
+    '''
+    closed = ['unexpectedly closed connection', '% ']
+    deadline = time.time() + (CONFIG_SETTLE if autoUpdate else 0)
     while True:
-        time.sleep(5)
-        response = readSerial()
-        if ('commit complete' in response):
+        if (expect(closed + ['# '], READ_TIMEOUT) != 2):
+            return False
+        remaining = deadline - time.time()
+        if (remaining <= 0):
+            return True
+        if (expect(closed, min(remaining, CONFIG_PROBE)) >= 0):
+            return False
+        writeSerial('\n')
+
+    
+@timed('upshift')
+def upshift():
+    '''
+    Raise the console speed for a bulk transfer. The change goes in with "commit confirmed"
+    so JUNOS reverts it by itself if we can't reach the switch at the new rate.
+    Returns True once the fast link answers and the change is confirmed.
+    '''
+    print('Raising console speed to ' + str(FAST_BAUDRATE) + ' baud...')
+    command('#', 'set system ports console speed ' + str(FAST_BAUDRATE), '\tSetting console speed...')
+    command('#', 'commit confirmed ' + str(UPSHIFT_ROLLBACK) + ' comment "console upshift"', '\tCommitting console speed...', False)
+    #The result may print before or after the port changes speed, a failure always prints at 9600
+    if (expect(['commit complete', 'commit failed'], READ_TIMEOUT*4) == 1):
+        print('Console speed was rejected, continuing at ' + str(DEFAULT_BAUDRATE) + ' baud')
+        command('#', 'delete system ports console speed', '')
+        return False
+    
+    setBaudrate(FAST_BAUDRATE)
+    if probeLink(['#'], LINK_PROBE):
+        command('#', 'commit comment "console upshift confirmed"', '\tConfirming console speed...')
+        if goodCommit():
+            print('Console running at ' + str(FAST_BAUDRATE) + ' baud.')
             return True
-        elif ('commit failed' in response):
-            print('-'*40)
-            print('Error: This commit has failed - This will require manual troubleshooting')
-            print('-'*40)
+    
+    #Fall back - either the switch never changed speed or it will roll back on its own
+    setBaudrate(DEFAULT_BAUDRATE)
+    if probeLink(['#'], LINK_PROBE):
+        print('Switch kept ' + str(DEFAULT_BAUDRATE) + ' baud, removing the speed change')
+        command('#', 'delete system ports console speed', '')
+        command('#', 'commit comment "console upshift removed"', '', False)
+        goodCommit()
+        return False
+    print('No answer at either speed, waiting for JUNOS to roll back (' + str(UPSHIFT_ROLLBACK) + ' minutes)...')
+    if probeLink(['#'], UPSHIFT_ROLLBACK*60 + LINK_PROBE*6):
+        print('Speed change rolled back, continuing at ' + str(DEFAULT_BAUDRATE) + ' baud')
+        return False
+    raise Exception('Fatal Error - console lost after changing speed')
+
+
+@timed('downshift')
+def downshift(committed):
+    '''
+    Return switch and host to 9600 after the final commit, from config mode if the
+    commit failed, otherwise from operational mode. A successful "commit and-quit"
+    is the only way to leave config mode, so a "}" at 9600 confirms the restore.
+    The host only drops its rate once the commit line has left the port and echoed
+    back, bytes still in flight at the old rate would reach the switch as garbage.
+    '''
+    if committed:
+        command('}', 'configure', '\nRestoring console speed to ' + str(DEFAULT_BAUDRATE) + ' baud...')
+    else:
+        command('#', 'rollback 0', '\nDiscarding failed changes, restoring console speed...')
+    command('#', 'delete system ports console speed', '')
+    line = 'commit and-quit comment "console downshift"'
+    command('#', line, '\tCommitting console speed...')
+    flushSerial()
+    if (expect([line], LINK_PROBE) < 0):
+        print('\tCommit did not echo, restoring host speed anyway')
+    setBaudrate(DEFAULT_BAUDRATE)
+    if probeLink(['}'], LINK_PROBE*6):
+        print('Console back at ' + str(DEFAULT_BAUDRATE) + ' baud.')
+        return
+    setBaudrate(FAST_BAUDRATE)
+    raise Exception('Fatal Error - unable to restore console speed, switch left at ' + str(FAST_BAUDRATE) + ' baud')
+
+    
+def commitConfig(arguments, reaction, check=False):
+    '''
+    Commit the candidate config, optionally running "commit check" first so a bad
+    config is caught before anything is applied. Returns True once JUNOS confirms.
+    '''
+    if check:
+        command('#', 'commit check', '\tChecking configuration...', False)
+        if goodCommit() != True:
             return False
+    command('#', 'commit ' + arguments, reaction, False)
+    return goodCommit()
+
+
+def goodCommit(timeout=None):
+    '''
+    Wait for absolute verification that a commit (or commit check) was successful,
+    returning as soon as JUNOS reports. A commit that never reports within
+    timeout (default COMMIT_TIMEOUT) seconds raises an exception.
+    '''
+    current = session()
+    #Every span a commit runs in takes at least as long as the commit
+    timeout = timeout or budget(current.spans[-1] if current.spans else '', COMMIT_TIMEOUT)
+    results = ['commit complete', 'configuration check succeeds', 'check-out failed', 'commit failed']
+    response = expect(results, timeout)
+    if (response in (0, 1)):
+        return True
+    elif (response in (2, 3)):
+        print('-'*40)
+        print('Error: This commit has failed - This will require manual troubleshooting')
+        for line in (session().before + results[response]).split('\n')[-6:]:  #JUNOS names the offending statements
+            if line.strip():
+                print('\t' + line.strip())
+        print('-'*40)
+        return False
+    raise Exception('Fatal Error - no commit result after ' + str(timeout) + ' seconds')
             
             
+@timed('identify')
+def chassisSerial():
+    '''Serial number of the connected switch, None if the inventory didn't come through'''
+    checkActivity()
+    goToState('operational')
+    for reply in showXml(['show chassis hardware']):
+        if ('chassis-inventory' in reply):
+            learnSwitch(reply)
+            return reply.get('serial-number')
+    return None
+
+
+def awaitSwitch(halted=False):
+    '''
+    Wait for a switch to answer on the console. A halted switch reboots at the first
+    key, so after a power-off nothing is sent until the next switch shows boot or login
+    text - stray bytes from the halted one don't count.
+    '''
+    if halted:
+        patterns = [text for texts, name in BOOT_MILESTONES for text in texts]
+        while (expect(patterns, CONVEYOR_PROBE) < 0):
+            pass
+    while not probeLink(CONSOLE_PROMPTS, CONVEYOR_PROBE):
+        pass
+    session().state = None
+    return
+
+
+def followBoot(milestones, phase, timeout):
+    '''
+    Read the console straight through a reboot or power-off, printing each milestone the
+    moment it shows up with the time left by past runs on this model. Returns the seconds
+    taken once the last milestone appears, raises if the switch stalls past the deadline.
+    '''
+    current = session()
+    start = time.time()
+    names = [name for texts, name in milestones]
+    #Milestone times are stored as phase/milestone spans, the last one is the whole wait
+    usual = dict([(name, percentile(times, 50)) for name, times in
+        [(name, phaseTimes(phase + '/' + name)) for name in names] if (len(times) >= PROFILE_MIN_RUNS)])
+    deadline = start + budget(phase + '/' + names[-1], timeout)
+    reached, mark = 0, 0.0      #Milestones passed, and when the last one was
+
+    def left(elapsed):
+        if (names[-1] not in usual):
+            return ''
+        since = usual.get(names[reached - 1], mark) if reached else 0.0
+        remaining = usual[names[-1]] - since - (elapsed - mark)
+        return (', about %ds to go' % remaining) if (remaining >= 1) else ', due any moment'
+
+    while (reached < len(milestones)):
+        patterns, indexes = [], []
+        for index in range(reached, len(milestones)):
+            patterns += milestones[index][0]
+            indexes += [index] * len(milestones[index][0])
+        remaining = deadline - time.time()
+        if (remaining <= 0):
+            raise Exception('No ' + names[-1] + ' after ' + str(int(deadline - start)) + ' seconds, the switch stalled '
+                + ('after: ' + names[reached - 1] if reached else 'before shutting down'))
+        found = expect(patterns, min(remaining, PROGRESS_INTERVAL))
+        elapsed = time.time() - start
+        if (found < 0):
+            print('\t%4ds ...%s' % (elapsed, left(elapsed)))
+            continue
+        reached, mark = indexes[found] + 1, elapsed
+        current.samples.append((phase + '/' + names[reached - 1], elapsed, True, start))
+        print('\t%4ds %s%s' % (elapsed, names[reached - 1], left(elapsed) if (reached < len(milestones)) else ''))
+    return time.time() - start
+
+
+def awaitUnplug():
+    '''Wait until the console stops answering, UNPLUG_PROBES checks in a row'''
+    unanswered = 0
+    while (unanswered < UNPLUG_PROBES):
+        clearBuffer()
+        writeSerial('\n')
+        if (expect(CONSOLE_PROMPTS, PROBE_WAIT) >= 0):
+            unanswered = 0
+            pause(CONVEYOR_PROBE)
+        else:
+            unanswered += 1
+    current = session()
+    current.state = current.model = current.version = None     #The next switch may be another model
+    current.samples = []
+    return
+
+
+def findDrive():
+    '''
+    The first slice of the USB drive in the switch, waiting up to DRIVE_TIMEOUT for one
+    to be plugged in. Disks with a mounted slice are the switch's own flash. The device
+    list is checked again as soon as the kernel reports a disk attaching, None at the timeout.
+    '''
+    deadline = time.time() + DRIVE_TIMEOUT
+    waiting = False
+    while True:
+        listing = shellRun('mount; ls -1 /dev/da*s1') or ''    #One per line, a tty gets columns
+        mounted = set(re.findall('^/dev/(da[0-9]+)s[^ ]* on ', listing, re.M))
+        for disk in re.findall('^/dev/(da[0-9]+)s1$', listing, re.M):
+            if (disk not in mounted):
+                return '/dev/' + disk + 's1'
+        remaining = deadline - time.time()
+        if (remaining <= 0):
+            return None
+        if not waiting:
+            print('Plug a USB drive into the switch (waiting ' + str(DRIVE_TIMEOUT) + ' seconds)...')
+            waiting = True
+        awaitAttach(min(remaining, DRIVE_POLL))
+
+
+def awaitAttach(timeout):
+    '''Watch the console for the kernel attaching a da disk, True once one has'''
+    current = session()
+    deadline = time.time() + timeout
+    while True:
+        attached = re.search('da[0-9]+: <', current.buffer)
+        if attached:
+            current.buffer = current.buffer[attached.end():]
+            print('USB drive attached')
+            return True
+        remaining = deadline - time.time()
+        if (remaining <= 0):
+            return False
+        pollSerial(min(remaining, PULL_INTERVAL))
+
+
+@timed('info_gathering')
 def gatherProvisioningInfo(configFile):
     '''
     Gathers model/serial/config file/mac/ip/subnet information,
     then passes it to a function to append a spreadsheet
+    Chassis and vlan details are read together as XML, the vlan is asked
+    again until DHCP gives it an address or DHCP_TIMEOUT passes
     '''
-    #Grab model/serial via chassis hardware
-    command('}', 'show chassis hardware | match chassis', '\nReviewing model information...')
-    time.sleep(5)
-    chassis = readSerial().split()
-    model = 'N/A'
-    serial = 'N/A'
-    try:
-        for i in range(len(chassis)):
-            if (chassis[i] == 'Chassis'):
-                model = chassis[i + 2]
-                serial = chassis[i + 1]
-    except:
-        pass
-                
+    print('\nReviewing model, MAC and IP/SUB information...')
+    commands = ['show chassis hardware', 'show interfaces vlan']
+    chassis, vlan = None, None
+    deadline = time.time() + DHCP_TIMEOUT
+    while True:
+        for reply in showXml(commands):
+            if ('chassis-inventory' in reply):
+                chassis = reply
+            elif ('interface-information' in reply):
+                vlan = reply
+        #Replies lost on the line are asked for again along with the lease
+        commands = [line for line, reply in (('show chassis hardware', chassis), ('show interfaces vlan', vlan))
+            if (reply is None) or ((line == 'show interfaces vlan') and ('ifa-local' not in reply))]
+        if (commands == []) or (time.time() > deadline):
+            break
+        print('...')
+        pause(DHCP_POLL)
+    chassis, vlan = chassis or {}, vlan or {}
+    learnSwitch(chassis)
+    
     #Config file name is the base of the filename
     name = os.path.basename(configFile).split('.')[0]
     
-    #Grab mac address from current interface
-    command('}', 'show interfaces vlan | find Current', 'Checking for MAC address...')
-    time.sleep(5)
-    current = readSerial().split()
-    mac = 'N/A'
-    try:
-        for i in range(len(current)):
-            if (current[i] == 'Current'):
-                mac = current[i + 2].rstrip(',')
-    except:
-        pass
-                
-    #Grab IP/SUB from interface destinations
-    command('}', 'show interfaces vlan | find Destination', 'Checking for IP/SUB...')
-    time.sleep(5)
-    destination = readSerial().split()
-    ip = 'N/A'
-    sub = 'N/A'
-    try:
-        for i in range(len(destination)):
-            if (destination[i] == 'Local:'):
-                ip = destination[i + 1].rstrip(',')
-                sub = destination[i + 3].rstrip(',')
-    except:
-        pass
-        
-    #Append all these to a CSV file
-    appendProvisioningLog(model, serial, name, mac, ip, sub)
+    #SUB has always been recorded as the broadcast address of the vlan
+    appendProvisioningLog(chassis.get('description', 'N/A'), chassis.get('serial-number', 'N/A'), name,
+        vlan.get('current-physical-address', 'N/A'), vlan.get('ifa-local', 'N/A'), vlan.get('ifa-broadcast', 'N/A'))
     return
 
 
+@timed('checksum')
+def activeChecksum():
+    '''
+    MD5 of the active config in set form. The config is saved and hashed on the switch,
+    so only the checksum crosses the console. None if the answer didn't come through.
+    '''
+    return readChecksum(runBatch(checksumCommands(), timeout=READ_TIMEOUT*2))
+
+
+def checksumCommands():
+    '''Save, hash and delete the scratch copy - it holds the root password hash'''
+    return ['show configuration | display set | except ## | save ' + CHECKSUM_FILE, 'file checksum md5 ' + CHECKSUM_FILE,
+        'file delete ' + CHECKSUM_FILE]
+
+
+def readChecksum(results):
+    '''The checksum in the batch results of checksumCommands(), None if it didn't come through'''
+    found = re.search(r'MD5 \([^)]*\) = ([0-9a-f]{32})', (results[-2][0] or '') if results else '')
+    return found.group(1) if found else None
+
+
+@timed('rescue_save')
+def rescueSave(checksum=False):
+    '''
+    Clone the active config to the rescue config. With checksum, the active config is
+    hashed in the same round trip and its checksum returned (see activeChecksum).
+    '''
+    print('\nCloning configs to rescue settings...')
+    results = runBatch(['request system configuration rescue save'] + (checksumCommands() if checksum else []),
+        timeout=READ_TIMEOUT*2)
+    if (results is None) or (results[0][1] != 0):
+        print('\tRescue save not confirmed: ' + ((results[0][0] or '').strip() if results else 'no answer'))
+    return readChecksum(results) if checksum else None
+
+
 def powerOff():
     '''Shutdown loop that prints "..." when powering off (so user knows the code has not frozen)'''    
     try:
@@ -593,29 +2123,31 @@ def powerOff():
         print('\t2) Shutdown Switch (2 min)')
         print('-'*40)
         choice = option(0, 2)
-        if (choice == 1):
+        if (choice != 2):
             return
             
         print('-'*40)
         print('Graceful Shutdown (2-3 minutes)')
         print('-'*40)
-        
-        goToLogin()
-        login()
-        cli()
-        command('}', 'request system power-off\nyes\n', 'Requested shutdown (3 minutes)...', True, False)
-        
-        while True:
-            time.sleep(15)
-            print('...')
-            if ('press any key' in readSerial()):
-                print('System shutdown complete.')
-                print('It is safe to unplug the Juniper')
-                break
+        haltSwitch()
                 
     except Exception as reason:
         returnException(reason)
     return
+
+
+@timed('power_off')
+def haltSwitch():
+    '''Request a power-off and wait until JUNOS reports it has halted'''
+    goToState('operational')
+    command('}', 'request system power-off\nyes\n', 'Requested shutdown (' + expected('power_off', '3 minutes') + ')...',
+        True, False)
+    session().state = None
+    followBoot(HALT_MILESTONES, 'power_off', HALT_TIMEOUT)
+    drainSerial()   #The halt banner's tail must not look like the next switch talking
+    print('System shutdown complete.')
+    print('It is safe to unplug the Juniper')
+    return True
             
          
 def reboot():
@@ -628,29 +2160,30 @@ def reboot():
         print('\t2) Reboot Switch (4 min)')
         print('-'*40)
         choice = option(0, 2)
-        if (choice == 1):
+        if (choice != 2):
             return
             
         print('-'*40)
         print('Graceful Reboot (4 minutes)')
         print('-'*40)
-        
-        goToLogin()
-        login()
-        cli()
-        command('}', 'request system reboot\nyes\n', 'Rebooting (3-4 minutes)...', True, False)
-        
-        while True:
-            time.sleep(15)
-            print('...')
-            if ('login:' in readSerial()):
-                print('Reboot complete, reached login prompt')
-                break
+        restartSwitch()
                 
     except Exception as reason:
         returnException(reason)
     return
 
+
+@timed('reboot')
+def restartSwitch():
+    '''Request a reboot and wait for the switch to come back to the login prompt'''
+    goToState('operational')
+    command('}', 'request system reboot\nyes\n', 'Rebooting (' + expected('reboot', '3-4 minutes') + ')...', True, False)
+    session().state = None
+    followBoot(BOOT_MILESTONES, 'reboot', BOOT_TIMEOUT)
+    print('Reboot complete, reached login prompt')
+    session().state = 'login'
+    return True
+
     
     
 ################################################################################
@@ -668,7 +2201,7 @@ def fileName():
             if (name == '.') or (name == '') or (name == '0'):
                 raise Exception('No file specified.')
                 
-            if (not name.endswith('.txt')) and (not name.endswith('.config')):
+            if (not name.endswith('.txt')) and (not name.endswith('.config')) and (not name.endswith('.tmpl')):
                 name = (name + '.txt')
             if ('/' not in name) or ('\\' not in name):
                 name = os.path.join(os.path.dirname(sys.argv[0]), name)
@@ -685,11 +2218,86 @@ def fileName():
     return ''
 
     
-def appendProvisioningLog(model, serial, config, mac, ip, sub):
-    '''Add an entry to provisioning logs'''
-    file = open(PROVISIONING_LOG, 'a')
-    file.write(model + ', ' + serial + ', ' + config + ', ' + mac + ', ' + ip + ', ' + sub + '\n')
+def openProvisioningStore():
+    '''
+    Open the provisioning database, creating it if needed. Each caller gets its own
+    connection - in WAL mode readers never block, and writers (fleet workers or other
+    SwitchPick instances) queue for up to PROVISIONING_TIMEOUT seconds.
+    '''
+    connection = sqlite3.connect(PROVISIONING_DB, timeout=PROVISIONING_TIMEOUT)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS deployments (id INTEGER PRIMARY KEY, '
+        'time TEXT, model TEXT, serial TEXT, config TEXT, mac TEXT, ip TEXT, sub TEXT)')
+    for field in ('serial', 'mac', 'config'):
+        connection.execute('CREATE INDEX IF NOT EXISTS deployments_' + field + ' ON deployments (' + field + ')')
+    return connection
+
+
+def initializeProvisioningStore():
+    '''Create the provisioning database, importing the old deployments.csv the first time'''
+    fresh = (os.path.exists(PROVISIONING_DB) != True)
+    connection = openProvisioningStore()
+    try:
+        if fresh and os.path.exists(PROVISIONING_LOG):
+            count = importProvisioningLog(connection, PROVISIONING_LOG)
+            print('Imported ' + str(count) + ' records from ' + PROVISIONING_LOG)
+    finally:
+        connection.close()
+    return
+
+
+def importProvisioningLog(connection, path):
+    '''Stream a "Model, Serial, Config, MAC, IP, SUB" CSV into the database, returns the row count'''
+    file = open(path, 'rb')
+    rows = (['', ] + [field.strip() for field in row[:6]]
+        for row in csv.reader(file, skipinitialspace=True)
+        if (len(row) >= 6) and (row[0].strip() != 'Model'))
+    with connection:
+        count = connection.executemany('INSERT INTO deployments (time, model, serial, config, mac, ip, sub) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)', rows).rowcount
     file.close()
+    return count
+
+
+def findProvisioningRecords(value):
+    '''Every deployment of a serial number, MAC address or config name, newest first'''
+    connection = openProvisioningStore()
+    try:
+        return connection.execute('SELECT time, model, serial, config, mac, ip, sub FROM deployments '
+            'WHERE serial = ? OR mac = ? OR config = ? ORDER BY id DESC',
+            (value.upper(), value.lower(), value)).fetchall()
+    finally:
+        connection.close()
+
+
+def exportProvisioningLog(path):
+    '''Stream every deployment to a CSV file, oldest first, returns the row count'''
+    connection = openProvisioningStore()
+    file = open(path, 'wb')
+    try:
+        writer = csv.writer(file)
+        writer.writerow(['Time', 'Model', 'Serial', 'Config', 'MAC', 'IP', 'SUB'])
+        count = 0
+        for row in connection.execute('SELECT time, model, serial, config, mac, ip, sub FROM deployments ORDER BY id'):
+            writer.writerow(row)
+            count += 1
+    finally:
+        file.close()
+        connection.close()
+    return count
+
+
+def appendProvisioningLog(model, serial, config, mac, ip, sub):
+    '''Add an entry to provisioning logs, noting when the switch was provisioned before'''
+    connection = openProvisioningStore()
+    try:
+        previous = connection.execute('SELECT time, config FROM deployments WHERE serial = ? '
+            'ORDER BY id DESC LIMIT 1', (serial,)).fetchone() if (serial != 'N/A') else None
+        with connection:
+            connection.execute('INSERT INTO deployments (time, model, serial, config, mac, ip, sub) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', (time.strftime('%Y-%m-%d %H:%M:%S'), model, serial, config, mac, ip, sub))
+    finally:
+        connection.close()
     print('-'*40)
     print('Appended to Provisioning Logs:')
     print(' .'*20)
@@ -699,18 +2307,609 @@ def appendProvisioningLog(model, serial, config, mac, ip, sub):
     print('MAC\t| ' + mac)
     print('IP\t| ' + ip)
     print('SUB\t| ' + sub)
+    if previous:
+        print('NOTE\t| Provisioned before, ' + (previous[0] or 'date unknown') + ' with ' + previous[1])
     print('-'*40)
     return
     
     
 def clearProvisioningLog():
-    '''Reset / create a fresh provisioning log'''
-    file = open(PROVISIONING_LOG, 'w')
-    file.write('Model, Serial, Config, MAC, IP, SUB\n')
-    file.close()
+    '''Remove every provisioning record'''
+    connection = openProvisioningStore()
+    try:
+        with connection:
+            connection.execute('DELETE FROM deployments')
+    finally:
+        connection.close()
     print('Provisioning records cleared to default')
     print('-'*40)
     return
+
+
+def loadManifest(path):
+    '''
+    Read a conveyor job manifest, a CSV with serial, port, actions and config columns.
+    Rows match a switch by serial number, by port (device name or position) or, with
+    both left blank, any switch. Actions are joined with "+" and run left to right,
+    config paths are relative to the manifest. Further columns fill in template fields.
+    '''
+    jobs = []
+    manifest = open(path, 'rb')
+    try:
+        for line, row in enumerate(csv.DictReader(manifest), 2):
+            row = dict([((key or '').strip().lower(), (value or '').strip()) for key, value in row.items()])
+            actions = [action.strip().lower() for action in row.get('actions', '').split('+') if action.strip()]
+            config = row.get('config', '')
+            if (actions == []):
+                raise Exception('line %d has no actions' % line)
+            for action in actions:
+                if (action not in CONVEYOR_ACTIONS):
+                    raise Exception('line %d, unknown action "%s" (use %s)' % (line, action, ', '.join(CONVEYOR_ACTIONS)))
+            if ('custom' in actions) and (config == ''):
+                raise Exception('line %d, custom needs a config file' % line)
+            #Any other columns fill in template fields, over the template's own table
+            variables = dict([(key, value) for key, value in row.items()
+                if value and (key not in ('serial', 'port', 'actions', 'config'))])
+            if config:
+                config = os.path.join(os.path.dirname(path), config)
+                if not os.path.isfile(config):
+                    raise Exception('line %d, no such config file: %s' % (line, config))
+                if not checkConfig(config, variables, row.get('serial', '').upper()):
+                    raise Exception('line %d, config file failed its checks: %s' % (line, config))
+            jobs.append({'serial': row.get('serial', '').upper(), 'port': row.get('port', ''),
+                'actions': actions, 'config': config, 'variables': variables})
+    finally:
+        manifest.close()
+    if [job for job in jobs if 'prime' in job['actions']] and not checkConfig(GENERAL_CONFIG):
+        raise Exception('priming config failed its checks: ' + GENERAL_CONFIG)
+    return jobs
+
+
+def manifestJob(jobs, serial, port, position):
+    '''The job for a switch - a serial match beats a port match, which beats a catch-all row'''
+    for job in jobs:
+        if job['serial'] and (job['serial'] == (serial or '').upper()):
+            return job
+    for job in jobs:
+        if (job['serial'] == '') and job['port'] and ((job['port'] == str(position)) or
+                (os.path.realpath(job['port']) == os.path.realpath(port))):
+            return job
+    for job in jobs:
+        if (job['serial'] == '') and (job['port'] == ''):
+            return job
+    return None
+
+
+def configLines(configData):
+    '''Config statements with comments, blank lines and spacing differences removed'''
+    lines = [' '.join(line.split()) for line in configData.splitlines()]
+    return [line for line in lines if line and not line.startswith('#') and not line.startswith('/*')]
+
+
+def configContext():
+    '''Settings besides the config file that shape what a load leaves on a switch'''
+    return hashlib.md5(session().encryptedPassword + '|' + str(DISABLE_AUTO_UPDATE)).hexdigest()
+
+
+def configKey(terminalType, configData):
+    '''Hash naming a config file as it would be loaded by this session'''
+    return hashlib.md5(configContext() + '|' + terminalType + '|' + '\n'.join(configLines(configData))).hexdigest()
+
+
+def openChecksumCache():
+    '''
+    The checksum cache lives with the provisioning records - it maps a config key to the
+    checksum a switch reported after loading it, and keeps set configs for delta loads
+    '''
+    connection = openProvisioningStore()
+    connection.execute('CREATE TABLE IF NOT EXISTS config_checksums (target TEXT PRIMARY KEY, '
+        'context TEXT, checksum TEXT, format TEXT, lines TEXT)')
+    connection.execute('CREATE INDEX IF NOT EXISTS config_checksums_checksum ON config_checksums (checksum)')
+    return connection
+
+
+def lookupConfigChecksum(key):
+    '''Checksum a switch reported the last time this config was loaded, None if never'''
+    connection = openChecksumCache()
+    try:
+        row = connection.execute('SELECT checksum FROM config_checksums WHERE target = ?', (key,)).fetchone()
+    finally:
+        connection.close()
+    return row[0] if row else None
+
+
+def storeConfigChecksum(key, checksum, terminalType, configData):
+    '''Remember the checksum a switch reported after loading a config'''
+    if (checksum is None):
+        return
+    connection = openChecksumCache()
+    try:
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO config_checksums (target, context, checksum, format, lines) '
+                'VALUES (?, ?, ?, ?, ?)', (key, configContext(), checksum, terminalType,
+                '\n'.join(configLines(configData)) if (terminalType == 'set') else ''))
+    finally:
+        connection.close()
+    return
+
+
+def deltaConfig(configData, checksum):
+    '''
+    Lines that turn the set config a switch is known to run (by its checksum) into this one,
+    deletes first. None when the switch state is unknown or the change isn't small.
+    '''
+    connection = openChecksumCache()
+    try:
+        row = connection.execute('SELECT lines FROM config_checksums WHERE checksum = ? AND context = ? '
+            'AND format = ? ORDER BY rowid DESC LIMIT 1', (checksum, configContext(), 'set')).fetchone()
+    finally:
+        connection.close()
+    lines = configLines(configData)
+    if (row is None) or [line for line in lines if not line.startswith('set ')]:
+        return None
+    previous = str(row[0]).split('\n')
+    current, known = set(lines), set(previous)
+    removed = [line for line in previous if line not in current]
+    added = [line for line in lines if line not in known]
+    if (len(removed) + len(added) > len(lines) * DELTA_LIMIT):
+        return None
+    return ['delete ' + line[len('set '):] for line in removed] + added
+    
+    
+    
+def templateTable(configFile):
+    '''A template's variables table sits beside it: closet.config.tmpl -> closet.csv'''
+    return re.sub(r'(\.config|\.txt)?\.tmpl$', '', configFile) + '.csv'
+
+
+def loadVariables(configFile):
+    '''
+    Read a template's variables table, a CSV with a serial column and one column per
+    field, into {serial: {field: value}}. A row without a serial holds the defaults.
+    '''
+    table = {}
+    path = templateTable(configFile)
+    if not os.path.isfile(path):
+        return table
+    variables = open(path, 'rb')
+    try:
+        for row in csv.DictReader(variables):
+            row = dict([((key or '').strip().lower(), (value or '').strip()) for key, value in row.items()])
+            serial = row.pop('serial', '').upper()
+            table[serial] = dict([(key, value) for key, value in row.items() if key and value])
+    finally:
+        variables.close()
+    return table
+
+
+def mergeVariables(table, serial, extra=None):
+    '''Fields for one switch - table defaults, then its row, then extra values (from a manifest)'''
+    variables = dict(table.get('', {}))
+    variables.update(table.get(serial.upper(), {}))
+    variables.update(extra or {})
+    variables['serial'] = serial
+    return variables
+
+
+def templateVariables(configFile, serial, extra=None):
+    return mergeVariables(loadVariables(configFile), serial, extra)
+
+
+def loadTemplate(configFile):
+    '''
+    Read and compile a template - its text is split into literal runs and ${field} names
+    once, and kept by hash. Set templates get the formatting readConfig gives .txt files
+    in their literal runs only, so values are never mistaken for format fields.
+    Returns the terminal type and the compiled template.
+    '''
+    terminalType = 'set' if configFile[:-len('.tmpl')].endswith('.txt') else 'override'
+    r = open(configFile, 'r')
+    text = r.read()
+    r.close()
+    key = hashlib.md5(terminalType + '|' + text).hexdigest()
+    with TEMPLATE_LOCK:
+        compiled = TEMPLATE_CACHE.pop(key, None)
+        if (compiled is None):
+            parts = TEMPLATE_FIELDS.split(text)
+            literals, names = parts[0::2], [name.lower() for name in parts[1::2]]
+            if (terminalType == 'set'):
+                literals = [literal.format(r'\r\n\\') for literal in literals]
+            compiled = (key, literals, names)
+        TEMPLATE_CACHE[key] = compiled      #Back in as the most recently used
+        while (len(TEMPLATE_CACHE) > TEMPLATE_CACHE_SIZE):
+            TEMPLATE_CACHE.popitem(False)
+    return terminalType, compiled
+
+
+def render(compiled, variables):
+    '''Fill in a compiled template, one join over its literal runs and values'''
+    key, literals, names = compiled
+    missing = sorted(set([name for name in names if name not in variables]))
+    if missing:
+        raise Exception('no value for ' + ', '.join(missing))
+    parts = [literals[0]]
+    for index in range(len(names)):
+        parts += [variables[names[index]], literals[index + 1]]
+    return ''.join(parts)
+
+
+def renderTemplate(configFile, variables):
+    '''Render a template for one switch, returns the terminal type and config data like readConfig'''
+    terminalType, compiled = loadTemplate(configFile)
+    return terminalType, render(compiled, variables)
+
+
+def lintConfig(configFile, variables=None, serial=None):
+    '''
+    Check a config file without a switch, the same way readConfig will prepare it
+    Returns (line, 'error' or 'warning', message) problems - errors would fail the
+    load or its commit, warnings leave a switch that can't be managed
+    '''
+    if configFile.endswith('.tmpl'):
+        return lintTemplate(configFile, variables, serial)
+    try:
+        terminalType, configData = readConfig(configFile)
+    except (ValueError, IndexError, KeyError) as reason:    #.txt files are run through str.format
+        return [(0, 'error', 'unescaped brace, write {{ or }} in set configs (' + str(reason) + ')')]
+    except (IOError, OSError) as reason:
+        return [(0, 'error', str(reason))]
+    if (configLines(configData) == []):
+        return [(0, 'error', 'no config statements')]
+    lint = lintSet if (terminalType == 'set') else lintStanza
+    return lint(configData)
+
+
+def lintTemplate(configFile, variables=None, serial=None):
+    '''Check a template as rendered for serial, or for every switch in its variables table'''
+    try:
+        terminalType, compiled = loadTemplate(configFile)
+        table = loadVariables(configFile)
+    except (ValueError, IndexError, KeyError) as reason:
+        return [(0, 'error', 'unescaped brace, write {{ or }} in set configs (' + str(reason) + ')')]
+    except (IOError, OSError, csv.Error) as reason:
+        return [(0, 'error', str(reason))]
+    lint = lintSet if (terminalType == 'set') else lintStanza
+    problems = []
+    for each in ([serial] if serial else (sorted([key for key in table if key]) or [''])):
+        label = ('for ' + each + ': ') if each else ''
+        try:
+            configData = render(compiled, mergeVariables(table, each, variables))
+        except Exception as reason:
+            problems.append((0, 'error', label + str(reason)))
+            continue
+        if (configLines(configData) == []):
+            problems.append((0, 'error', label + 'no config statements'))
+            continue
+        problems += [(line, severity, label + message) for line, severity, message in lint(configData)]
+    return problems
+
+
+def lintStanza(configData):
+    '''Brace, bracket and statement structure of an override config, plus what it must contain'''
+    problems, stack, words = [], [], []
+    start = 0       #Line the current statement started on
+    found = {'root': False, 'management': False}
+    inList = False
+    line, position = 1, 0
+
+    def statement(words):
+        path = [word for word in [word for frame in stack for word in frame[1]] + words
+            if word not in ('inactive:', 'protect:', 'replace:')]
+        if (len(stack) == 0) and path and (path[0] not in CONFIG_HIERARCHIES):
+            problems.append((line, 'error', 'unknown top level statement "' + path[0] + '"'))
+        if path[:2] == ['system', 'root-authentication']:
+            found['root'] = True
+        if (path[:1] == ['interfaces']) and (len(path) > 1) and (path[1] in MANAGEMENT_INTERFACES):
+            found['management'] = True
+        return
+
+    for match in CONFIG_TOKENS.finditer(configData):
+        line += configData.count('\n', position, match.start())
+        position = match.start()
+        token = match.group()
+        if (token == '/*'):
+            problems.append((line, 'error', 'comment is never closed'))
+            break
+        elif token.startswith('#') or token.startswith('/*'):
+            continue
+        elif (token == '"'):
+            problems.append((line, 'error', 'quote is never closed'))
+            break
+        elif (token == '['):
+            if inList or (words == []):
+                problems.append((line, 'error', 'unexpected "["'))
+            inList = True
+        elif (token == ']'):
+            if not inList:
+                problems.append((line, 'error', 'unexpected "]"'))
+            inList = False
+        elif (token == ';'):
+            if inList:
+                problems.append((line, 'error', '"[" is never closed'))
+                inList = False
+            if (words == []):
+                problems.append((line, 'error', 'empty statement'))
+            else:
+                statement(words)
+            words = []
+        elif (token == '{'):
+            if inList or (words == []):
+                problems.append((line, 'error', '"{" needs a statement name before it'))
+            elif (start < line):    #Containers open on the line they're named on, a ";" went missing
+                problems.append((start, 'error', 'statement "' + ' '.join(words[:-1]) + '" is missing its ";"'))
+                statement(words[-1:])
+                words = words[-1:]
+            else:
+                statement(words)
+            stack.append((line, words))
+            words, inList = [], False
+        elif (token == '}'):
+            if words:
+                problems.append((line, 'error', 'statement "' + ' '.join(words) + '" is missing its ";"'))
+                words = []
+            if (stack == []):
+                problems.append((line, 'error', 'unmatched "}"'))
+            else:
+                stack.pop()
+        else:
+            start = start if words else line
+            words.append(token)
+    if words:
+        problems.append((line, 'error', 'statement "' + ' '.join(words) + '" is missing its ";"'))
+    for opened, name in stack:
+        problems.append((opened, 'error', '"' + ' '.join(name) + ' {" is never closed'))
+    #An override replaces the password SwitchPick committed first, without one the commit fails
+    if not found['root']:
+        problems.append((0, 'error', 'no system root-authentication, override loads must set the root password'))
+    if not found['management']:
+        problems.append((0, 'warning', 'no management interface (' + ', '.join(MANAGEMENT_INTERFACES) + ')'))
+    return problems
+
+
+def lintSet(configData):
+    '''Command and quoting of each line of a set config, plus what it must not remove'''
+    problems = []
+    relative = False    #Lines after an edit are relative to it, their paths can't be checked
+    management = False
+    for line, text in enumerate(configData.split('\n'), 1):
+        words = []
+        for match in CONFIG_TOKENS.finditer(text):
+            if (match.group() == '"'):
+                problems.append((line, 'error', 'quote is never closed'))
+            elif not match.group().startswith('#') or words:
+                words.append(match.group())
+        if (words == []) or words[0].startswith('/*'):
+            continue
+        command, path = words[0], [word for word in words[1:] if word not in ('{', '}', '[', ']', ';')]
+        if (command not in SET_COMMANDS):
+            problems.append((line, 'error', 'unknown command "' + command + '"'))
+            continue
+        if (command == 'edit'):
+            relative = True
+        elif (command == 'top'):
+            relative = False
+        if relative or (command in ('edit', 'top', 'up', 'exit')):
+            continue
+        if (path == []):
+            if (command != 'delete'):
+                problems.append((line, 'error', '"' + command + '" needs a statement'))
+        elif (path[0] not in CONFIG_HIERARCHIES):
+            problems.append((line, 'error', 'unknown top level statement "' + path[0] + '"'))
+        if (command in ('delete', 'deactivate')) and ((path == []) or (path == ['system']) or
+                (path[:2] == ['system', 'root-authentication'])):
+            problems.append((line, 'error', command + ' removes the root password SwitchPick commits first'))
+        if (command == 'set') and (path[:1] == ['interfaces']) and (path[1:2] != []) and (path[1] in MANAGEMENT_INTERFACES):
+            management = True
+    if not management:
+        problems.append((0, 'warning', 'no management interface (' + ', '.join(MANAGEMENT_INTERFACES) + ')'))
+    return problems
+
+
+def checkConfig(configFile, variables=None, serial=None):
+    '''Print what lintConfig finds in a config file, True if nothing stops it loading'''
+    problems = lintConfig(configFile, variables, serial)
+    for line, severity, message in problems:
+        print(configFile + (':' + str(line) if line else '') + ': ' + severity + ': ' + message)
+    return not [problem for problem in problems if problem[1] == 'error']
+
+
+def lintPaths(paths):
+    '''Check config files, and the configs and templates under directories, returns how many have errors'''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, names, filenames in os.walk(path):
+                files += [os.path.join(directory, name) for name in sorted(filenames)
+                    if (name.endswith('.config') or name.endswith('.txt') or name.endswith('.tmpl'))
+                    and (name != os.path.basename(CREDENTIAL_FILE))]
+        else:
+            files.append(path)
+    failed = len([configFile for configFile in files if not checkConfig(configFile)])
+    print(str(len(files)) + ' config files checked, ' + str(failed) + ' with errors.')
+    return failed
+    
+    
+    
+################################################################################
+#                                      Console Reactor
+################################################################################
+
+class Reactor(object):
+    '''
+    One I/O thread for every registered console. select() wakes it when any port
+    has data, the bytes go straight into that port's buffer (so the small hardware
+    buffer never overruns while a worker is busy) and only that port's worker is woken.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.consoles = {}
+        self.wakeRead, self.wakeWrite = os.pipe()
+        self.thread = threading.Thread(target=self.run, name='reactor')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def register(self, console):
+        with self.lock:
+            self.consoles[console.fileno()] = console
+        os.write(self.wakeWrite, '+')   #Interrupt select() so the new fd is watched
+        return
+
+    def unregister(self, console):
+        with self.lock:
+            for fd in [fd for fd in self.consoles if self.consoles[fd] is console]:
+                del self.consoles[fd]
+        os.write(self.wakeWrite, '-')
+        return
+
+    def run(self):
+        while True:
+            with self.lock:
+                fds = list(self.consoles)
+            try:
+                readable = select.select(fds + [self.wakeRead], [], [])[0]
+            except (select.error, OSError, ValueError):
+                #A port was closed under us, drop whatever is no longer open. Ports
+                #unregistered since the snapshot are already gone
+                with self.lock:
+                    for fd in fds:
+                        console = self.consoles.get(fd)
+                        if (console is not None) and not console.serial.isOpen():
+                            del self.consoles[fd]
+                            console.hangup()
+                continue
+            for fd in readable:
+                if (fd == self.wakeRead):
+                    os.read(fd, 512)
+                    continue
+                console = self.consoles.get(fd)
+                if console is None:
+                    continue
+                try:
+                    data = os.read(fd, 4096)
+                except OSError as error:
+                    if (error.errno == errno.EAGAIN):
+                        continue
+                    data = ''
+                if data:
+                    console.feed(data)
+                else:   #EOF/EIO, the adapter was unplugged
+                    self.unregister(console)
+                    console.hangup()
+
+
+class ReactorConsole(object):
+    '''
+    Stands in for a pyserial port (read/write/inWaiting/timeout) but reads are served
+    from bytes the reactor already collected. A waiting worker blocks in select() on a
+    private pipe, so parked workers cost no CPU until their own port has data.
+    '''
+    def __init__(self, port, reactor):
+        self.serial = port
+        self.reactor = reactor
+        self.timeout = port.timeout
+        self.data = ''
+        self.connected = True
+        self.lock = threading.Lock()
+        self.signalRead, self.signalWrite = os.pipe()
+        flags = fcntl.fcntl(self.signalWrite, fcntl.F_GETFL)
+        fcntl.fcntl(self.signalWrite, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        reactor.register(self)
+
+    def fileno(self):
+        return self.serial.fileno()
+
+    def signal(self):
+        try:
+            os.write(self.signalWrite, '.')
+        except OSError:
+            pass    #Pipe already full, the worker has a wakeup pending
+        return
+
+    def feed(self, data):
+        with self.lock:
+            self.data = (self.data + data)[-BUFFER_LIMIT:]
+        self.signal()
+        return
+
+    def hangup(self):
+        self.connected = False
+        self.signal()
+        return
+
+    def inWaiting(self):
+        with self.lock:
+            return len(self.data)
+
+    def read(self, size=1):
+        deadline = None if (self.timeout is None) else (time.time() + self.timeout)
+        while True:
+            with self.lock:
+                if (len(self.data) >= size) or (not self.connected):
+                    break
+            remaining = None if (deadline is None) else (deadline - time.time())
+            if (remaining is not None) and (remaining <= 0):
+                break
+            if select.select([self.signalRead], [], [], remaining)[0]:
+                os.read(self.signalRead, 4096)
+        with self.lock:
+            chunk, self.data = self.data[:size], self.data[size:]
+        if (chunk == '') and (size > 0) and (not self.connected):
+            raise serial.SerialException('Console disconnected')
+        return chunk
+
+    def write(self, data):
+        return self.serial.write(data)
+
+    def flush(self):
+        self.serial.flush()
+        return
+
+    def isOpen(self):
+        return self.connected and self.serial.isOpen()
+
+    def getBaudrate(self):
+        return self.serial.baudrate
+
+    def setBaudrate(self, rate):
+        self.serial.baudrate = rate
+
+    baudrate = property(getBaudrate, setBaudrate)
+
+    def release(self):
+        '''Stop watching the port and hand back the pyserial object and unread bytes'''
+        self.reactor.unregister(self)
+        os.close(self.signalRead)
+        os.close(self.signalWrite)
+        return self.serial, self.data
+
+    def close(self):
+        self.release()[0].close()
+        return
+
+
+def reactorSupported():
+    '''The reactor needs select() on serial file descriptors'''
+    return (os.name == 'posix') and (fcntl is not None)
+
+
+def attachReactor(sessions):
+    '''Move each session's console onto the shared reactor thread'''
+    global REACTOR
+    if REACTOR is None:
+        REACTOR = Reactor()
+    for current in sessions:
+        if not isinstance(current.console, ReactorConsole):
+            current.console = ReactorConsole(current.console, REACTOR)
+    return
+
+
+def detachReactor(sessions):
+    '''Return sessions to direct pyserial reads, keeping any bytes already collected'''
+    for current in sessions:
+        if isinstance(current.console, ReactorConsole):
+            current.console, data = current.console.release()
+            current.buffer = (current.buffer + data)[-BUFFER_LIMIT:]
+    return
     
     
     
@@ -723,35 +2922,366 @@ def readSerial():
     Read and return bytes in the serial buffer. NOTE, there is a physical restriction
     that limits buffer size to around 400-500 chars and losing data in transmission
     is common for these interfaces. To keep reading excess chars to a minimum, we only read the
-    same amount as chars in the buffer.
+    same amount as chars in the buffer. Bytes already collected by expect() come first.
     '''
-    dataBytes = CONSOLE.inWaiting()
+    current = session()
+    console = current.console
+    data, current.buffer = current.buffer, ''
+    dataBytes = console.inWaiting()
     if dataBytes:
-        return CONSOLE.read(dataBytes)
-    else:
-        return ''
+        received = console.read(dataBytes)
+        current.bytesIn += len(received)
+        transcribe('R', received)
+        data += received
+    return data
+
+
+def pollSerial(timeout):
+    '''
+    Wait up to timeout seconds for console data and add it to the session buffer.
+    Returns the number of bytes read - the wait ends as soon as the first byte arrives.
+    '''
+    current = session()
+    console = current.console
+    if (console.timeout != timeout):
+        console.timeout = timeout
+    start = time.time()
+    data = console.read(1)
+    current.readTime += time.time() - start
+    if data:
+        data += console.read(console.inWaiting())
+        current.buffer = (current.buffer + data)[-BUFFER_LIMIT:]
+        current.bytesIn += len(data)
+        transcribe('R', data)
+    return len(data)
+
+
+def flushSerial():
+    '''Block until everything written to the console has left the host port (tcdrain)'''
+    session().console.flush()
+    return
+
+
+def setBaudrate(rate):
+    '''Reopen the host side of the console at a new rate'''
+    session().console.baudrate = rate
+    clearBuffer()
+    return
+
+
+def probeLink(patterns, timeout):
+    '''
+    Nudge the console until a prompt answers two newlines in a row, which rules out
+    a lucky byte in line noise after a speed change. False at the deadline.
+    '''
+    deadline = time.time() + timeout
+    answered = 0
+    while (time.time() < deadline):
+        clearBuffer()
+        writeSerial('\n')
+        if (expect(patterns, PULL_INTERVAL) >= 0):
+            answered += 1
+            if (answered == 2):
+                return True
+        else:
+            answered = 0
+    return False
+
+
+def clearBuffer():
+    '''Drop stale console output so the next match comes from fresh data'''
+    readSerial()
+    return
+
+
+def expect(patterns, timeout=READ_TIMEOUT):
+    '''
+    Wait until any of the patterns appears on the console and return its index,
+    or -1 once the deadline passes. Reads accumulate in a rolling buffer so a prompt
+    split across two reads still matches, and the earliest match in the stream wins.
+    Text up to and including the match is consumed, the part before it is kept
+    in session().before for callers that need command output.
+    '''
+    current = session()
+    deadline = time.time() + timeout
+    while True:
+        found, position, end = -1, -1, 0
+        for index in range(len(patterns)):
+            at = current.buffer.find(patterns[index])
+            if (at >= 0) and ((found < 0) or (at < position)):
+                found, position, end = index, at, at + len(patterns[index])
+        if (found >= 0):
+            current.before = current.buffer[:position]
+            current.buffer = current.buffer[end:]
+            return found
+        remaining = deadline - time.time()
+        if (remaining <= 0):
+            return -1
+        pollSerial(min(remaining, PULL_INTERVAL))
+
+
+def writeSerial(data, secret=False):
+    '''Write data to the console of the current session, secrets reach the transcript redacted'''
+    session().console.write(data)
+    session().bytesOut += len(data)
+    transcribe('T', TRANSCRIPT_SECRET if secret else data)
+    return
         
         
-def command(condition, command, reaction='', pullPrompt=True, newLine=True):
+def command(condition, command, reaction='', pullPrompt=True, newLine=True, timeout=None):
     '''
     When a condition is passed from the serial device, respond with a command,
     then print a notification to user terminal.
     Optional: "Pull" prompts by pressing enter every second, which prevents
     the program from hanging when JUNOS fails to provide prompts.
+    Optional: give up with an exception after timeout seconds.
     '''
+    deadline = (time.time() + timeout) if timeout else None
+    if (pullPrompt == True):
+        clearBuffer()   #Only a freshly pulled prompt counts
     while True:
         if (pullPrompt == True):
-            CONSOLE.write('\n') #Brute-force the console to respond
-        time.sleep(1)
-        response = readSerial()
-        if (condition in response):
-            CONSOLE.write(command + ('\n' if newLine else ''))
+            writeSerial('\n') #Brute-force the console to respond
+        if (expect([condition], PULL_INTERVAL) >= 0):
+            writeSerial(command + ('\n' if newLine else ''))
             print(reaction)
             break
+        if deadline and (time.time() > deadline):
+            raise Exception('Timed out waiting for "' + condition + '" from the console')
     return
     
     
     
+def shellRun(line, timeout=READ_TIMEOUT):
+    '''
+    Run a shell command line and return its output, None at the timeout. The output is
+    framed by echoed markers and read straight off the console, so it can be far
+    longer than the rolling buffer.
+    '''
+    current = session()
+    clearBuffer()
+    writeSerial('echo "' + SHELL_MARKER + '""-BEGIN"; ' + line + '; echo "' + SHELL_MARKER + '""-END"\n')
+    deadline = time.time() + timeout
+    output, scanned = '', 0
+    while True:
+        end = output.find(SHELL_MARKER + '-END', scanned)
+        if (end >= 0):
+            break
+        scanned = max(0, len(output) - len(SHELL_MARKER) - 4)
+        remaining = deadline - time.time()
+        if (remaining <= 0):
+            return None
+        pollSerial(min(remaining, PULL_INTERVAL))
+        output += readSerial()
+    current.buffer = output[end + len(SHELL_MARKER) + 4:]  #The prompt after the marker
+    begin = output.find(SHELL_MARKER + '-BEGIN')
+    output = output[(begin + len(SHELL_MARKER) + 6) if (begin >= 0) else 0:end]
+    return output.replace('\r\n', '\n').strip('\n')
+
+
+def runBatch(commands, shell=False, timeout=READ_TIMEOUT):
+    '''
+    Run several operational (or shell) commands in one round trip, returning an
+    (output, status) pair for each - status 0 for success - or None at the timeout.
+    Shell commands are chained on one line, each followed by an echoed marker with its
+    exit status. CLI commands are typed back to back: the CLI only echoes a line once
+    the command before it has finished, so each echo marks the end of the output before
+    it, and the prompt the first echo follows marks the end of the last one. CLI status
+    is 1 when JUNOS reports an error.
+    '''
+    current = session()
+    if shell:
+        output = shellRun('; '.join([line + '; echo "' + SHELL_MARKER + '""-DONE" ' + str(index) + ' $status'
+            for index, line in enumerate(commands)]), timeout)
+        if (output is None):
+            return None
+        results, start = [], 0
+        for marker in re.finditer(SHELL_MARKER + r'-DONE ([0-9]+) ([0-9]+)\n?', output):
+            results.append((output[start:marker.start()].strip('\n'), int(marker.group(2))))
+            start = marker.end()
+        return results + [(None, None)] * (len(commands) - len(results))
+    
+    command('}', '\n'.join(commands), '')
+    deadline = time.time() + timeout
+    output, end = '', -1
+    while True:
+        first = output.find(commands[0])
+        last = output.find(commands[-1], max(0, first))
+        if (first >= 0) and (last >= 0):
+            prompt = output[output.rfind('\n', 0, first) + 1:first] or '> '
+            end = output.find('\n' + prompt, last + len(commands[-1]))
+            if (end >= 0):
+                break
+        remaining = deadline - time.time()
+        if (remaining <= 0):
+            return None
+        pollSerial(min(remaining, PULL_INTERVAL))
+        output += readSerial()
+    current.buffer = output[end + len(prompt) + 1:]
+    output = output[:end + 1].replace('\r\n', '\n')
+    
+    #Each command's output runs from its echo to the line holding the next echo
+    results, position = [], 0
+    for index in range(len(commands)):
+        at = output.find(commands[index], position)
+        if (at < 0):    #Echo garbled on the line, the output can't be told apart
+            results.append((None, None))
+            continue
+        start = at + len(commands[index])
+        following = [output.find(line, start) for line in commands[index + 1:index + 2]]
+        end = following[0] if (following and following[0] >= 0) else len(output)
+        end = output.rfind('\n', start, end) + 1 or end
+        text = '\n'.join([line for line in output[start:end].split('\n') if not re.match(r'^\{.*\}$', line.strip())])
+        status = 1 if re.search(r'^\s*(error:|unknown command|syntax error)', text, re.M) else 0
+        results.append((text.strip('\n'), status))
+        position = end
+    return results
+
+
+def fetchFile(path, directory):
+    '''
+    Copy a file off the switch as base64 over the console into directory, checked against
+    the MD5 the switch reports. Garbled transfers are retried, returns the MD5 or raises.
+    '''
+    name = os.path.basename(path)
+    results = runBatch(['md5 -q ' + path, 'wc -c ' + path], shell=True) or [(None, None)] * 2
+    details = (results[1][0] or '').split()
+    if [status for output, status in results if status != 0] or not details or not details[0].isdigit():
+        raise Exception('Unable to read ' + path + ' on the switch: ' + ' '.join([output or '' for output, status in results]))
+    checksum = results[0][0].strip()
+    #Base64 adds a third and 10 bits go down the line per byte, plus headroom for a busy switch
+    timeout = READ_TIMEOUT + int(details[0]) * 4 / 3 * 10 * 2 / session().console.baudrate
+    for attempt in range(STREAM_RETRIES + 1):
+        output = shellRun('uuencode -m ' + path + ' ' + name, timeout)
+        lines = (output or '').split('\n')
+        starts = [index for index in range(len(lines)) if lines[index].startswith('begin-base64')]
+        if starts and ('====' in lines):
+            try:
+                data = base64.b64decode(''.join([line.strip() for line in lines[starts[0] + 1:lines.index('====')]]))
+            except (TypeError, ValueError):    #Line noise left it undecodable
+                data = None
+            if (data is not None) and (hashlib.md5(data).hexdigest() == checksum):
+                local = open(os.path.join(directory, name), 'wb')
+                local.write(data)
+                local.close()
+                return checksum
+        print('\tTransfer of ' + name + ' failed its checksum, retrying...')
+    raise Exception('Unable to stream ' + path + ' intact after ' + str(STREAM_RETRIES + 1) + ' attempts')
+
+
+def uploadFile(data, path):
+    '''
+    Copy data onto the switch as gzipped base64, typed into cat at the pace the shell
+    echoes it and decoded there. Checked against the MD5 the switch reports, garbled
+    transfers are retried. Returns the MD5 or raises.
+    '''
+    checksum = hashlib.md5(data).hexdigest()
+    packed = io.BytesIO()
+    archive = gzip.GzipFile(fileobj=packed, mode='wb', mtime=0)
+    archive.write(data)
+    archive.close()
+    encoded = base64.b64encode(packed.getvalue())
+    name = os.path.basename(path)
+    text = ('begin-base64 644 ' + name + '.gz\n' +
+        ''.join([encoded[start:start + 76] + '\n' for start in range(0, len(encoded), 76)]) + '====\n')
+    for attempt in range(STREAM_RETRIES + 1):
+        clearBuffer()
+        writeSerial('cat > ' + path + '.b64\n')
+        if (expect(['\n'], READ_TIMEOUT) < 0):
+            raise Exception('The shell did not take the upload')
+        clearBuffer()
+        try:
+            pasteConfig(text, attempt == 0)     #Retries check every line before it is committed
+            writeSerial('\x04')
+        except Exception:       #Give up on this attempt, cat would take the rest as data
+            writeSerial('\x03')
+            drainSerial()
+            print('\tUpload of ' + name + ' garbled, retrying...')
+            continue
+        results = runBatch(['uudecode -o ' + path + '.gz ' + path + '.b64', 'gunzip -f ' + path + '.gz',
+            'rm -f ' + path + '.b64', 'md5 -q ' + path], shell=True, timeout=LOAD_TIMEOUT) or [(None, None)]
+        if (results[-1][1] == 0) and (results[-1][0].strip() == checksum):
+            return checksum
+        failed = [output for output, status in results[:2] if status]
+        print('\tUpload of ' + name + ' ' + ('failed: ' + failed[0].strip() if failed else 'failed its checksum') + ', retrying...')
+    raise Exception('Unable to upload ' + path + ' intact after ' + str(STREAM_RETRIES + 1) + ' attempts')
+
+
+class XmlFields(object):
+    '''
+    ElementTree parser target that keeps the text of the first element with each tag,
+    namespaces stripped. Containers are kept as empty strings so replies can be told apart.
+    The JUNOS version in the reply's namespaces is kept as junos-version.
+    '''
+    def __init__(self):
+        self.fields = {}
+        self.text = []
+
+    def start(self, tag, attributes):
+        self.text = []
+        version = re.match('{http://xml.juniper.net/junos/([^/]+)/', tag)
+        if version and ('junos-version' not in self.fields):
+            self.fields['junos-version'] = version.group(1)
+
+    def data(self, data):
+        self.text.append(data)
+
+    def end(self, tag):
+        tag = tag.split('}')[-1]
+        if tag not in self.fields:
+            self.fields[tag] = ''.join(self.text).strip()
+        self.text = []
+
+    def close(self):
+        return self.fields
+
+
+def showXml(commands):
+    '''
+    Type show commands back to back as "| display xml" and parse each reply as it arrives.
+    Returns the fields of every reply that came through whole, in order.
+    '''
+    command('}', '\n'.join([line + ' | display xml | no-more' for line in commands]), '')
+    replies = []
+    for line in commands:
+        reply = readXml(READ_TIMEOUT*4)
+        if reply is not None:
+            replies.append(reply)
+    return replies
+
+
+def readXml(timeout):
+    '''
+    Stream the next <rpc-reply> on the console through an XML parser, returning its
+    fields (see XmlFields). None if no reply starts in time, or it is cut short or garbled.
+    '''
+    current = session()
+    if (expect(['<rpc-reply'], timeout) < 0):
+        return None
+    end = '</rpc-reply>'
+    parser = ElementTree.XMLParser(target=XmlFields())
+    deadline = time.time() + timeout
+    try:
+        parser.feed('<rpc-reply')
+        while True:
+            at = current.buffer.find(end)
+            if (at >= 0):
+                parser.feed(current.buffer[:at + len(end)])
+                current.buffer = current.buffer[at + len(end):]
+                return parser.close()
+            #Feed what has arrived, holding back what could be the start of the end tag
+            split = max(0, len(current.buffer) - len(end) + 1)
+            parser.feed(current.buffer[:split])
+            current.buffer = current.buffer[split:]
+            remaining = deadline - time.time()
+            if (remaining <= 0):
+                return None
+            pollSerial(min(remaining, PULL_INTERVAL))
+    except ElementTree.ParseError:
+        return None
+    
+    
+    
 ################################################################################
 #                                      Tertiary Operations
 ################################################################################
@@ -786,4 +3316,5 @@ def returnException(reason):
 #                                      Function Calls
 ################################################################################
 
-main()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
\ No newline at end of file